@@ -1,397 +1,506 @@
-from datetime import datetime, timedelta
-import xarray as xr
+from datetime import datetime
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 import geopandas as gpd
 import numpy as np
-from gfs_downloader import download_gfs_for_target
+from gfs_downloader import download_gfs_to_archive
+from grib_archive import open_archive
+import eccodes
+from gif_encoder import IncrementalGifWriter
+from forecast_store import ForecastStore
+from field_loader import open_forecast_runs, compute_run_statistics, DEFAULT_WORKERS
+from scale import QuantileSketch, ScaleClimatology, adaptive_range
+from run_planner import plan_fetch, fetch_set, AvailabilityIndex
+from contour_cache import get_contours
+from frame_renderer import CompositeFrameRenderer
+from profiling import mark_stage
+import os
 import sys
+import hashlib
 import pandas as pd
 
-def create_forecast_evolution_animation(target_time, days_back=5, variable='HGT', 
-                                       level='500_mb', output_file='current_forecast.gif'):
-    """Crea animazione evoluzione previsione per un'ora target fissata"""
+# Configurazione variabili con range fissi
+VAR_CONFIGS = {
+    'HGT': {'name': 'gh', 'cmap': 'RdYlBu_r', 'label': 'Geopotenziale (m)', 
+            'title': 'Geopotenziale 500 hPa', 'contour': True, 'contour_levels': 20,
+            'vmin_fixed': 5400, 'vmax_fixed': 5880, 'adaptive_scale': True},
+    'APCP': {'name': 'tp', 'cmap': 'Blues', 'label': 'Precipitazione (mm)', 
+             'title': 'Precipitazione', 'contour': False,
+             'vmin_fixed': 0, 'vmax_fixed': 50},
+    'TMP': {'name': 't', 'cmap': 'RdYlBu_r', 'label': 'Temperatura (°C)', 
+            'title': 'Temperatura', 'contour': True, 'contour_levels': 15,
+            'convert_to_celsius': True,
+            'vmin_fixed': -10, 'vmax_fixed': 35, 'adaptive_scale': True}
+}
+
+
+# Area visualizzata (lon, lat)
+PIEMONTE_XLIM = [6.5, 9.3]
+PIEMONTE_YLIM = [44.0, 46.6]
+
+# Da incrementare quando cambia l'aspetto dei frame (invalida i frame in cache)
+FRAME_STYLE_VERSION = 5
+
+# Simboli per lo stato dei run nel piano
+PLAN_ICONS = {'warm': '♨️', 'available': '✓', 'unknown': '?', 'missing': '✗',
+              'pending': '⏳', 'expired': '⌛'}
+
+
+def load_piemonte_boundary():
+    """Scarica i confini del Piemonte"""
+    url = "https://geodata.ucdavis.edu/gadm/gadm4.1/json/gadm41_ITA_1.json"
+    italy_regions = gpd.read_file(url)
+    return italy_regions[italy_regions['NAME_1'] == 'Piemonte']
+
+
+def compute_scale(config, variable, data_min, data_max, sketch=None, climatology=None):
+    """
+    Calcola vmin/vmax. Con adaptive_scale usa i percentili dello sketch dei run
+    (allargati alla climatologia stagionale), altrimenti il range fisso se
+    configurato, altrimenti min/max dei dati.
+    """
+    robust = adaptive_range(config, sketch, climatology) if config.get('adaptive_scale') else None
+    if robust is not None:
+        data_min, data_max = robust
+    elif 'vmin_fixed' in config and 'vmax_fixed' in config:
+        return config['vmin_fixed'], config['vmax_fixed']
+    
+    if variable == 'HGT':
+        vmin = np.floor(data_min / 10) * 10
+        vmax = np.ceil(data_max / 10) * 10
+    elif variable == 'TMP':
+        vmin = np.floor(data_min)
+        vmax = np.ceil(data_max)
+    else:
+        margin = (data_max - data_min) * 0.1
+        vmin = data_min - margin
+        vmax = data_max + margin
+    if vmax <= vmin:
+        # Campo uniforme: serve comunque un intervallo non nullo
+        vmax = vmin + 1
+    return vmin, vmax
+
+
+def decode_grib_message(data, variable, config):
+    """
+    Decodifica con eccodes il primo messaggio GRIB (come fa cfgrib) da byte
+    in memoria, ad es. letti dall'archivio. Restituisce un dict con values,
+    latitude, longitude e valid_time.
+    """
+    gid = eccodes.codes_new_from_message(bytes(data))
+    try:
+        ni = eccodes.codes_get(gid, 'Ni')
+        nj = eccodes.codes_get(gid, 'Nj')
+        values = np.asarray(eccodes.codes_get_values(gid), dtype=np.float32).reshape(nj, ni)
+        
+        if eccodes.codes_get(gid, 'bitmapPresent'):
+            values[values == eccodes.codes_get(gid, 'missingValue')] = np.nan
+        
+        latitude = np.linspace(eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees'),
+                               eccodes.codes_get(gid, 'latitudeOfLastGridPointInDegrees'), nj)
+        longitude = np.linspace(eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees'),
+                                eccodes.codes_get(gid, 'longitudeOfLastGridPointInDegrees'), ni)
+        
+        validity = f"{eccodes.codes_get(gid, 'validityDate')}{eccodes.codes_get(gid, 'validityTime'):04d}"
+        valid_time = pd.Timestamp(datetime.strptime(validity, '%Y%m%d%H%M'))
+    finally:
+        eccodes.codes_release(gid)
+    
+    # CONVERSIONE IN CELSIUS per temperatura
+    if variable == 'TMP' and config.get('convert_to_celsius', False):
+        values = values - 273.15
+    
+    return {
+        'values': values,
+        'latitude': latitude,
+        'longitude': longitude,
+        'valid_time': valid_time,
+    }
+
+
+class RunningForecastStats:
+    """
+    Statistiche raccolte run per run, senza tenere in memoria i campi.
+    RMSE e min/max si calcolano in compute_run_statistics (field_loader).
+    """
+    
+    def __init__(self):
+        self.run_dates = []
+        self.rmses = []
+        self.data_min = np.inf
+        self.data_max = -np.inf
+    
+    def add(self, run_time, rmse, data_min, data_max):
+        """Aggiunge le statistiche di un run calcolate da compute_run_statistics"""
+        self.run_dates.append(run_time)
+        self.rmses.append(rmse)
+        self.data_min = min(self.data_min, data_min)
+        self.data_max = max(self.data_max, data_max)
+        print(f"    RMSE vs riferimento: {rmse:.2f}")
+        return rmse
+    
+    def add_cached(self, run_time, rmse):
+        """Aggiunge un RMSE già calcolato rispetto allo stesso riferimento"""
+        self.run_dates.append(run_time)
+        self.rmses.append(rmse)
+        print(f"    RMSE vs riferimento (cache): {rmse:.2f}")
+    
+    def as_dict(self):
+        return {
+            'run_dates': list(self.run_dates),
+            'rmses': list(self.rmses),
+            'data_min': self.data_min,
+            'data_max': self.data_max,
+        }
+
+
+def frame_title(config, field, run_time, target_time):
+    """Titolo del frame: target, run e scarto tra tempo dei dati e target"""
+    hours_ahead = int((target_time - run_time).total_seconds() / 3600)
+    
+    actual_time = field['valid_time']
+    time_info = ""
+    if actual_time != pd.Timestamp(target_time):
+        time_diff = int((actual_time - pd.Timestamp(target_time)).total_seconds() / 3600)
+        time_info = f" (dati: {actual_time.strftime('%H:00')} UTC, diff: {time_diff:+d}h)"
+    
+    return (f'{config["title"]} - Previsione per {target_time.strftime("%d/%m/%Y %H:00 UTC")}{time_info}\n' +
+            f'Run: {run_time.strftime("%d/%m/%Y %H:00 UTC")} ({hours_ahead}h prima)')
+
+
+def create_forecast_evolution_stream(target_time, days_back=5, variable='HGT',
+                                     level='500_mb', output_file='current_forecast.gif',
+                                     cache_dir=None, archive_dir='gfs_archive',
+                                     cache_manager=None):
+    """
+    Crea l'animazione dell'evoluzione della previsione per un'ora target fissata.
+    Ogni run viene scaricato, decodificato, aggiunto alle statistiche,
+    disegnato e scritto nella GIF, poi rilasciato: la memoria resta costante
+    qualunque sia days_back. Restituisce solo le statistiche (dict).
+    
+    Campi decodificati e frame codificati restano in cache su disco
+    (ForecastStore): a un refresh si scaricano e disegnano solo i run nuovi.
+    I GRIB scaricati finiscono nell'archivio a pack per ciclo (GribArchive).
+    Con un CacheManager, cache e cicli usati restano protetti dall'eviction
+    durante la generazione.
+    
+    La cache è condivisa tra processi e repliche (shared_cache, cartella da
+    METEO_SHARED_CACHE_DIR se cache_dir è None): un'animazione già generata
+    per gli stessi run viene copiata in output_file senza rifarla.
+    
+    Dentro una profiling.ProfileSession ogni fase viene misurata a parte.
+    """
     
     print("="*60)
-    print("INIZIO CREAZIONE ANIMAZIONE")
+    print("INIZIO CREAZIONE ANIMAZIONE (streaming)")
     print(f"Target: {target_time}")
     print(f"Variable: {variable}, Level: {level}")
     print(f"Days back: {days_back}")
     print("="*60)
     sys.stdout.flush()
     
-    try:
-        # Scarica confini Piemonte
-        print("\n[1/5] 📥 Caricamento confini Piemonte...")
-        sys.stdout.flush()
-        url = "https://geodata.ucdavis.edu/gadm/gadm4.1/json/gadm41_ITA_1.json"
-        italy_regions = gpd.read_file(url)
-        piemonte = italy_regions[italy_regions['NAME_1'] == 'Piemonte']
-        print(f"✓ Confini caricati: {len(piemonte)} geometrie")
-        sys.stdout.flush()
-    except Exception as e:
-        print(f"✗ ERRORE caricamento confini: {e}")
-        sys.stdout.flush()
-        raise
-    
-    try:
-        # Genera lista run SOLO quelli che possono forecast il target
-        print("\n[2/5] 📅 Generazione lista run validi...")
-        sys.stdout.flush()
-        run_times = []
-        current = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-        current = current.replace(hour=(current.hour // 6) * 6)
-        
-        max_forecast_hours = 384  # 16 giorni max GFS
-        
-        for i in range(days_back * 4):
-            run_time = current - timedelta(hours=i * 6)
-            
-            # Calcola se questo run può avere il forecast per il target
-            forecast_hours_needed = int((target_time - run_time).total_seconds() / 3600)
-            
-            if 0 <= forecast_hours_needed <= max_forecast_hours:
-                run_times.append(run_time)
-                print(f"  ✓ Run {run_time.strftime('%d/%m %H:00')} può forecast {forecast_hours_needed}h")
-            else:
-                print(f"  ✗ Run {run_time.strftime('%d/%m %H:00')} fuori range ({forecast_hours_needed}h)")
-        
-        run_times.reverse()
-        print(f"✓ Generati {len(run_times)} run validi da scaricare")
-        sys.stdout.flush()
-        
-        if len(run_times) < 2:
-            error_msg = f"ERRORE: Solo {len(run_times)} run validi! Prova con target più vicino o meno giorni di storico."
-            print(f"\n{error_msg}")
-            sys.stdout.flush()
-            raise Exception(error_msg)
-            
-    except Exception as e:
-        print(f"✗ ERRORE generazione run: {e}")
-        sys.stdout.flush()
-        raise
+    config = VAR_CONFIGS.get(variable, VAR_CONFIGS['HGT'])
+    store = ForecastStore(target_time, variable, level, cache_dir=cache_dir)
+    archive = open_archive(archive_dir)
     
-    # Scarica file
-    print(f"\n[3/5] 📥 Download {len(run_times)} file GRIB...")
+    mark_stage('piano')
+    print("\n[1/4] 📅 Pianificazione run (indice disponibilità)...")
     sys.stdout.flush()
-    files = []
+    plan = plan_fetch(target_time, days_back, variable, level, archive=archive, store=store,
+                      index=AvailabilityIndex(os.path.join(archive_dir, 'availability.json')))
+    for entry in plan:
+        print(f"  {PLAN_ICONS[entry['status']]} Run {entry['run_time'].strftime('%d/%m %H:00')} "
+              f"f{entry['lead']:03d}: {entry['status']}")
+    run_times = [entry['run_time'] for entry in fetch_set(plan)]
+    print(f"✓ {len(run_times)} run da usare, {sum(entry['warm'] for entry in plan)} già in locale")
+    
+    if len(run_times) < 2:
+        error_msg = f"ERRORE: Solo {len(run_times)} run validi! Prova con target più vicino o meno giorni di storico."
+        print(f"\n{error_msg}")
+        sys.stdout.flush()
+        raise Exception(error_msg)
     
-    for idx, run_time in enumerate(run_times):
-        print(f"\n  [{idx+1}/{len(run_times)}] Run: {run_time.strftime('%Y-%m-%d %H:00 UTC')}")
+    if cache_manager is None:
+        return _shared_forecast_stream(target_time, variable, level, output_file,
+                                       run_times, config, store, archive)
+    
+    in_use = [path for path in [store.root] + [archive.cycle_files(run_time)[0] for run_time in run_times] if path]
+    with cache_manager.pin(*in_use):
+        result = _shared_forecast_stream(target_time, variable, level, output_file,
+                                         run_times, config, store, archive, cache_manager)
+    cache_manager.register_file(output_file)
+    cache_manager.request_eviction()
+    return result
+
+
+def _shared_forecast_stream(target_time, variable, level, output_file, run_times,
+                            config, store, archive, cache_manager=None):
+    """
+    Animazione dalla cache condivisa se un altro processo l'ha già generata per
+    gli stessi run, altrimenti la genera (una replica alla volta per chiave).
+    """
+    run_keys = ','.join(run_time.strftime('%Y%m%d%H') for run_time in run_times)
+    key = hashlib.sha1(f"v{FRAME_STYLE_VERSION}|{run_keys}".encode('utf-8')).hexdigest()[:16]
+    
+    def generate():
+        result = _render_forecast_stream(target_time, variable, level, output_file, run_times,
+                                         config, store, archive, cache_manager)
+        with open(output_file, 'rb') as f:
+            data = f.read()
+        info = dict(result, run_dates=[run_time.strftime('%Y%m%d%H') for run_time in result['run_dates']])
+        del info['output_file']
+        # Se mancava qualche run l'animazione condivisa scade presto (vedi load_animation)
+        return data, info, len(result['run_dates']) == len(run_times)
+    
+    (data, info), generated = store.get_animation(key, generate)
+    if cache_manager is not None:
+        cache_manager.record('miss' if generated else 'hit')
+    if not generated:
+        mark_stage('copia')
+        tmp = f"{output_file}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, output_file)
+        print(f"\n✅ Animazione già generata per gli stessi run, copiata in {output_file}")
         sys.stdout.flush()
-        
+    return dict(info, run_dates=[datetime.strptime(run, '%Y%m%d%H') for run in info['run_dates']],
+                output_file=output_file)
+
+
+def _render_forecast_stream(target_time, variable, level, output_file, run_times,
+                            config, store, archive, cache_manager=None):
+    """Download, statistiche, rendering e codifica dei run (vedi create_forecast_evolution_stream)"""
+    
+    def record(event):
+        if cache_manager is not None:
+            cache_manager.record(event)
+    
+    def ensure_available(run_time):
+        """Scarica il GRIB in archivio se serve, senza decodificarlo"""
+        if store.has_field(run_time):
+            return True
         try:
-            file = download_gfs_for_target(target_time, run_time, variable=variable, level=level)
-            if file:
-                files.append((run_time, file))
-                print(f"    ✓ Successo")
-            else:
+            lead = download_gfs_to_archive(target_time, run_time, archive, variable=variable, level=level)
+            if lead is None:
                 print(f"    ✗ Download fallito")
-            sys.stdout.flush()
+                return False
+            leads[run_time] = lead
+            return True
         except Exception as e:
             print(f"    ✗ Eccezione: {e}")
+            return False
+        finally:
             sys.stdout.flush()
     
-    if not files:
-        error_msg = "ERRORE: Nessun file scaricato con successo!"
-        print(f"\n{error_msg}")
-        sys.stdout.flush()
-        raise Exception(error_msg)
-    
-    print(f"\n✓ Scaricati {len(files)}/{len(run_times)} file")
-    sys.stdout.flush()
+    def decode(run_time):
+        lead = leads.get(run_time)
+        if lead is None:
+            lead = download_gfs_to_archive(target_time, run_time, archive, variable=variable, level=level)
+        return decode_grib_message(archive.read(run_time, variable, level, lead), variable, config)
     
-    # Configurazione variabili con range fissi
-    var_configs = {
-        'HGT': {'name': 'gh', 'cmap': 'RdYlBu_r', 'label': 'Geopotenziale (m)', 
-                'title': 'Geopotenziale 500 hPa', 'contour': True, 'contour_levels': 20,
-                'vmin_fixed': 5400, 'vmax_fixed': 5880},
-        'APCP': {'name': 'tp', 'cmap': 'Blues', 'label': 'Precipitazione (mm)', 
-                 'title': 'Precipitazione', 'contour': False,
-                 'vmin_fixed': 0, 'vmax_fixed': 50},
-        'TMP': {'name': 't', 'cmap': 'RdYlBu_r', 'label': 'Temperatura (°C)', 
-                'title': 'Temperatura', 'contour': True, 'contour_levels': 15,
-                'convert_to_celsius': True,
-                'vmin_fixed': -10, 'vmax_fixed': 35}
-    }
-    
-    config = var_configs.get(variable, var_configs['HGT'])
-    
-    # Carica datasets
-    print("\n[4/5] 📖 Caricamento datasets GRIB...")
-    sys.stdout.flush()
-    all_values = []
-    datasets = []
+    def load_field(run_time):
+        """Campo decodificato: dalla cache condivisa se c'è, altrimenti dall'archivio"""
+        field, decoded = store.get_field(run_time, decode)
+        record('miss' if decoded else 'hit')
+        return field
     
-    for idx, (run_time, file) in enumerate(files):
+    def load_values(run_time):
         try:
-            print(f"  [{idx+1}/{len(files)}] Lettura {file}...")
-            sys.stdout.flush()
-            
-            ds = xr.open_dataset(file, engine='cfgrib')
-            
-            var_name = config['name']
-            if var_name not in ds:
-                available = list(ds.data_vars.keys())
-                print(f"    ⚠️ Variabile '{var_name}' non trovata. Disponibili: {available}")
-                if available:
-                    var_name = available[0]
-                    print(f"    Uso: {var_name}")
-                sys.stdout.flush()
-            
-            # CONVERSIONE IN CELSIUS per temperatura
-            if variable == 'TMP' and config.get('convert_to_celsius', False):
-                ds[var_name] = ds[var_name] - 273.15
-                print(f"    ✓ Temperatura convertita in Celsius")
-            
-            datasets.append((run_time, ds))
-            all_values.append(ds[var_name].values)
-            print(f"    ✓ OK - Tempo: {ds.time.values}")
-            sys.stdout.flush()
+            return load_field(run_time)['values']
         except Exception as e:
-            print(f"    ✗ Errore lettura: {e}")
+            print(f"    ✗ Errore decodifica {run_time.strftime('%d/%m %H:00')}: {e}")
             sys.stdout.flush()
+            return np.full(reference['values'].shape, np.nan, dtype=reference['values'].dtype)
     
-    if not datasets:
-        error_msg = "ERRORE: Nessun dataset caricato con successo!"
-        print(f"\n{error_msg}")
-        sys.stdout.flush()
-        raise Exception(error_msg)
-    
-    print(f"✓ Caricati {len(datasets)} datasets")
+    # Prima si scaricano i GRIB mancanti; la decodifica avviene solo
+    # per i run di cui servono davvero i dati (statistiche o frame nuovi)
+    mark_stage('download')
+    print("\n[2/4] 📥 Download run mancanti...")
     sys.stdout.flush()
-    
-    # Verifica che tutti i dataset abbiano il tempo target
-    print("\n🎯 Verifica tempi target...")
-    valid_datasets = []
-    
-    for run_time, ds in datasets:
+    leads = {}
+    available = []
+    for run_time in run_times:
+        print(f"  Run: {run_time.strftime('%Y-%m-%d %H:00 UTC')}")
+        if ensure_available(run_time):
+            available.append(run_time)
+    
+    # Il riferimento per l'RMSE è il run più recente disponibile
+    mark_stage('riferimento')
+    reference = None
+    while available and reference is None:
         try:
-            available_times = ds.time.values
-            target_np = np.datetime64(target_time)
-            
-            # Gestisci sia array che valori scalari
-            if available_times.ndim == 0:
-                available_times = np.array([available_times])
-            
-            # Verifica che il tempo nel dataset sia quello target (entro 1 minuto)
-            time_match = np.abs(available_times - target_np) < np.timedelta64(1, 'm')
-            
-            if np.any(time_match):
-                valid_datasets.append((run_time, ds))
-                actual_time = available_times[np.argmax(time_match)] if available_times.size > 1 else available_times[0]
-                print(f"  ✓ {run_time.strftime('%d/%m %H:00')} → {pd.Timestamp(actual_time).strftime('%d/%m %H:00')}")
-            else:
-                actual_time = available_times[0] if available_times.size > 0 else "N/A"
-                time_diff = np.abs(actual_time - target_np).astype('timedelta64[h]').astype(int)
-                print(f"  ⚠️ {run_time.strftime('%d/%m %H:00')} tempo diverso: {pd.Timestamp(actual_time).strftime('%d/%m %H:00')} (diff: {time_diff}h)")
-                # Accettiamo comunque il dataset
-                valid_datasets.append((run_time, ds))
-                
+            reference = load_field(available[-1])
         except Exception as e:
-            print(f"  ✗ Errore verifica {run_time.strftime('%d/%m %H:00')}: {e}")
-            continue
-    
-    datasets = valid_datasets
+            print(f"  ✗ Riferimento {available[-1].strftime('%d/%m %H:00')} illeggibile: {e}")
+            available.pop()
     
-    if len(datasets) < 2:
-        error_msg = f"ERRORE: Solo {len(datasets)} dataset validi!"
+    if reference is None:
+        error_msg = "ERRORE: Nessun file scaricato con successo!"
         print(f"\n{error_msg}")
         sys.stdout.flush()
         raise Exception(error_msg)
     
-    print(f"✓ Dataset finali: {len(datasets)}")
+    run_times = available
+    reference_run = run_times[-1]
+    print(f"✓ Riferimento: {reference_run.strftime('%d/%m %H:00')}")
     
-    # CALCOLO RANGE VALORI CON SCALA FISSA
-    print("\n🎯 Configurazione scala fissa...")
+    cached_rmses = store.cached_rmses(reference_run)
+    adaptive = config.get('adaptive_scale', False)
     
-    if 'vmin_fixed' in config and 'vmax_fixed' in config:
-        vmin = config['vmin_fixed']
-        vmax = config['vmax_fixed']
-        print(f"✓ Scala fissa: {vmin} - {vmax}")
-    else:
-        data_min = np.nanmin([np.nanmin(v) for v in all_values])
-        data_max = np.nanmax([np.nanmax(v) for v in all_values])
-        
-        if variable == 'HGT':
-            vmin = np.floor(data_min / 10) * 10
-            vmax = np.ceil(data_max / 10) * 10
-        elif variable == 'TMP':
-            vmin = np.floor(data_min)
-            vmax = np.ceil(data_max)
+    # RMSE, min/max e sketch dei quantili dei run che non li hanno in cache,
+    # in parallelo chunk per chunk: un solo passaggio sui dati
+    missing = [run_time for run_time in run_times
+               if run_time.strftime('%Y%m%d%H') not in cached_rmses
+               or (adaptive and store.load_sketch(run_time) is None)]
+    mark_stage('statistiche')
+    print(f"\n  📊 Statistiche per {len(missing)} run (dask, {DEFAULT_WORKERS} thread)...")
+    sys.stdout.flush()
+    runs = open_forecast_runs(missing, load_values, reference)
+    run_stats = compute_run_statistics(runs, reference['values'],
+                                       sketch=QuantileSketch.for_variable(variable) if adaptive else None,
+                                       xlim=PIEMONTE_XLIM, ylim=PIEMONTE_YLIM)
+    
+    # Scala pronta prima del rendering: percentili di tutti i run + climatologia stagionale.
+    # Una volta calcolata resta fissa per il target, così ai refresh i frame in cache valgono
+    if adaptive:
+        # In climatologia vanno solo i run mai visti (gli altri hanno già uno sketch salvato)
+        new_sketches = [run_stat['sketch'] for run_time, run_stat in run_stats.items()
+                        if store.load_sketch(run_time) is None]
+        for run_time, run_stat in run_stats.items():
+            store.set_sketch(run_time, run_stat['sketch'])
+        climatology = ScaleClimatology(os.path.join(store.cache_dir, 'climatology.json'))
+        frozen = store.load_scale()
+        if frozen is not None:
+            vmin, vmax = frozen
         else:
-            margin = (data_max - data_min) * 0.1
-            vmin = data_min - margin
-            vmax = data_max + margin
-        
-        print(f"✓ Scala calcolata dai dati: {vmin:.1f} - {vmax:.1f}")
+            sketch = QuantileSketch.for_variable(variable)
+            for run_time in run_times:
+                sketch.merge(store.load_sketch(run_time))
+            seasonal = climatology.sketch(variable, level, target_time)
+            vmin, vmax = compute_scale(config, variable, None, None, sketch=sketch, climatology=seasonal)
+            store.set_scale(vmin, vmax)
+        if new_sketches:
+            climatology.add(variable, level, target_time, new_sketches)
+    else:
+        vmin, vmax = compute_scale(config, variable,
+                                   float(np.nanmin(reference['values'])),
+                                   float(np.nanmax(reference['values'])))
+    print(f"✓ Scala: {vmin} - {vmax}")
     
-    sys.stdout.flush()
+    # I frame dipendono dalla scala: frame disegnati con un'altra scala non valgono
+    frame_style = f"v{FRAME_STYLE_VERSION}_{vmin:g}_{vmax:g}"
+    stats = RunningForecastStats()
     
-    # Crea animazione
-    print("\n[5/5] 🎬 Creazione animazione GIF...")
+    mark_stage('rendering')
+    print(f"\n[3/4] 🎬 Rendering e codifica di {len(run_times)} run...")
     sys.stdout.flush()
     
-    fig, ax = plt.subplots(figsize=(12, 10))
+    # Figura e confini servono solo se c'è almeno un frame da disegnare
+    renderer = None
     
-    def animate(i):
-        print(f"  Frame {i+1}/{len(datasets)}", end='\r')
-        sys.stdout.flush()
-        
-        ax.clear()
-        run_time, ds = datasets[i]
-        
-        var_name = config['name']
-        if var_name not in ds:
-            var_name = list(ds.data_vars.keys())[0]
+    def render_frame(run_time, writer):
+        """Disegna e codifica un frame, restituisce (blocco GIF, dimensione)"""
+        nonlocal renderer
+        field = reference if run_time == reference_run else load_field(run_time)
         
-        # PLOT CON SCALA FISSA
-        im = ds[var_name].plot(ax=ax, cmap=config['cmap'], vmin=vmin, vmax=vmax, 
-                               add_colorbar=False)
+        if renderer is None:
+            print("  📥 Caricamento confini Piemonte...")
+            renderer = CompositeFrameRenderer(config, vmin, vmax, load_piemonte_boundary(),
+                                              xlim=PIEMONTE_XLIM, ylim=PIEMONTE_YLIM)
         
+        contours = None
         if config.get('contour', False):
             levels = np.linspace(vmin, vmax, config.get('contour_levels', 20))
-            cs = ax.contour(ds.longitude, ds.latitude, ds[var_name], 
-                           levels=levels, colors='black', linewidths=0.5, alpha=0.5)
-            ax.clabel(cs, inline=True, fontsize=8, fmt='%.1f' if variable == 'TMP' else '%d')
-        
-        piemonte.boundary.plot(ax=ax, color='red', linewidth=2)
-        
-        ax.set_xlim([6.5, 9.3])
-        ax.set_ylim([44.0, 46.6])
-        
-        hours_ahead = int((target_time - run_time).total_seconds() / 3600)
-        
-        # Ottieni il tempo effettivo del dataset
-        actual_time = ds.time.values
-        if actual_time.ndim == 0:
-            actual_time = pd.Timestamp(actual_time)
-        else:
-            actual_time = pd.Timestamp(actual_time[0])
-        
-        time_info = ""
-        if actual_time != target_time:
-            time_diff = int((actual_time - pd.Timestamp(target_time)).total_seconds() / 3600)
-            time_info = f" (dati: {actual_time.strftime('%H:00')} UTC, diff: {time_diff:+d}h)"
-        
-        ax.set_title(f'{config["title"]} - Previsione per {target_time.strftime("%d/%m/%Y %H:00 UTC")}{time_info}\n' +
-                    f'Run: {run_time.strftime("%d/%m/%Y %H:00 UTC")} ({hours_ahead}h prima)',
-                    fontsize=14, fontweight='bold')
-        
-        ax.set_xlabel('Longitudine')
-        ax.set_ylabel('Latitudine')
-        ax.grid(True, alpha=0.3)
+            contours = get_contours(field, levels, PIEMONTE_XLIM, PIEMONTE_YLIM,
+                                    cache_dir=store.fields_dir)
         
-        return [im]
+        frame = renderer.render(field, frame_title(config, field, run_time, target_time),
+                                contours=contours,
+                                contour_fmt='%.1f' if variable == 'TMP' else '%d')
+        return writer.encode_frame(frame), (frame.shape[1], frame.shape[0])
     
-    # CREAZIONE COLORBAR CON SCALA FISSA
-    cbar = plt.colorbar(plt.cm.ScalarMappable(cmap=config['cmap'], 
-                        norm=plt.Normalize(vmin=vmin, vmax=vmax)),
-                       ax=ax, label=config['label'])
-    
-    print("\n  Rendering frames...")
-    sys.stdout.flush()
-    
-    anim = animation.FuncAnimation(fig, animate, frames=len(datasets),
-                                  interval=800, blit=False, repeat=True)
+    try:
+        with IncrementalGifWriter(output_file, fps=1.5) as writer:
+            for idx, run_time in enumerate(run_times):
+                print(f"\n  [{idx+1}/{len(run_times)}] Run: {run_time.strftime('%Y-%m-%d %H:00 UTC')}")
+                sys.stdout.flush()
+                
+                cached_frame = store.load_frame(run_time, frame_style)
+                rmse = cached_rmses.get(run_time.strftime('%Y%m%d%H'))
+                
+                if rmse is None:
+                    run_stat = run_stats[run_time]
+                    rmse = run_stat['rmse']
+                    if np.isnan(rmse):
+                        continue
+                    stats.add(run_time, rmse, run_stat['min'], run_stat['max'])
+                else:
+                    stats.add_cached(run_time, rmse)
+                
+                if cached_frame is None:
+                    # Un'altra replica può disegnare lo stesso frame: si disegna una volta sola
+                    with store.lock_frame(run_time, frame_style):
+                        cached_frame = store.load_frame(run_time, frame_style)
+                        if cached_frame is None:
+                            record('miss')
+                            block, size = render_frame(run_time, writer)
+                            store.save_frame(run_time, frame_style, block, size)
+                            writer.add_encoded_frame(block, size)
+                            continue
+                
+                print(f"    ✓ Frame in cache")
+                record('hit')
+                writer.add_encoded_frame(*cached_frame)
+            
+            if writer.n_frames < 2:
+                error_msg = f"ERRORE: Solo {writer.n_frames} dataset validi!"
+                print(f"\n{error_msg}")
+                sys.stdout.flush()
+                raise Exception(error_msg)
+    finally:
+        if renderer is not None:
+            renderer.close()
     
-    print(f"\n  💾 Salvataggio in {output_file}...")
-    sys.stdout.flush()
+    mark_stage('salvataggio')
+    store.set_rmses(reference_run, dict(zip(stats.run_dates, stats.rmses)))
+    store.save_meta()
     
-    try:
-        Writer = animation.writers['pillow']
-        writer = Writer(fps=1.5, metadata=dict(artist='GFS Forecast'), bitrate=1800)
-        anim.save(output_file, writer=writer)
-        print(f"  ✓ Salvato!")
-        sys.stdout.flush()
-    except Exception as e:
-        print(f"  ✗ ERRORE salvataggio: {e}")
-        sys.stdout.flush()
-        raise
+    print(f"\n[4/4] 💾 Salvato in {output_file}")
     
-    plt.close()
+    result = stats.as_dict()
+    result.update({'vmin': vmin, 'vmax': vmax, 'output_file': output_file})
     
     print("\n" + "="*60)
     print(f"✅ ANIMAZIONE COMPLETATA: {output_file}")
-    print(f"📊 Scala fissa: {vmin} - {vmax} {config['label'].split('(')[-1].split(')')[0]}")
-    print(f"📈 Dataset utilizzati: {len(datasets)}")
+    print(f"📊 Scala: {vmin} - {vmax} {config['label'].split('(')[-1].split(')')[0]}")
+    print(f"📈 Run utilizzati: {len(result['run_dates'])}")
     print("="*60)
     sys.stdout.flush()
     
-    return anim, datasets
-    
-def create_rmse_analysis(datasets, target_time, variable_name):
-    """Crea analisi RMSE per l'evoluzione delle previsioni"""
-    
-    print("📊 Calcolo RMSE spaziale...")
-    
-    # Mappa nomi variabili GRIB
-    var_name_map = {
-        'HGT': 'gh',
-        'APCP': 'tp', 
-        'TMP': 't'
-    }
-    
-    grib_var_name = var_name_map.get(variable_name, variable_name.lower())
-    
-    forecasts = []
-    run_dates = []
-    
-    # Estrai previsioni da ogni dataset
-    for run_time, dataset in datasets:
-        if grib_var_name in dataset:
-            try:
-                # VERIFICA: Controlla le dimensioni della variabile
-                data_var = dataset[grib_var_name]
-                print(f"  Analisi {run_time.strftime('%d/%m %H:00')}: dims={data_var.dims}, shape={data_var.shape}")
-                
-                # Se non ha dimensione time, usa direttamente la variabile
-                if 'time' not in data_var.dims:
-                    forecast = data_var
-                    print(f"    ✓ Variabile senza dimensione time")
-                else:
-                    # Se ha dimensione time, prendi il primo elemento
-                    if data_var.dims:
-                        forecast = data_var.isel(time=0)
-                    else:
-                        forecast = data_var
-                    print(f"    ✓ Variabile con dimensione time")
-                    
-                forecasts.append(forecast)
-                run_dates.append(run_time)
-                print(f"✓ Run {run_time.strftime('%d/%m %H:00')} utilizzato")
-                
-            except Exception as e:
-                print(f"✗ Errore run {run_time.strftime('%d/%m %H:00')}: {e}")
-                continue
-    
-    print(f"📈 Run validi per RMSE: {len(forecasts)}/{len(datasets)}")
-    
-    if len(forecasts) < 2:
-        print("❌ Non abbastanza dati per calcolo RMSE")
-        return None
-    
-    # Ultimo run come riferimento
-    last_run_forecast = forecasts[-1]
-    
-    # Calcola RMSE spaziale
-    rmses = []
-    for i, forecast in enumerate(forecasts):
-        try:
-            rmse = np.sqrt(((forecast - last_run_forecast)**2).mean())
-            rmses.append(float(rmse))
-            print(f"  RMSE run {run_dates[i].strftime('%d/%m %H:00')}: {float(rmse):.2f}")
-        except Exception as e:
-            print(f"  ✗ Errore calcolo RMSE per {run_dates[i].strftime('%d/%m %H:00')}: {e}")
+    return result
+
+
+def point_series(target_time, variable, level, run_dates, lat, lon, cache_dir=None):
+    """
+    Valore nel punto di griglia più vicino a (lat, lon) per ogni run,
+    letto dai campi già in cache. Restituisce [(run, valore), ...].
+    """
+    store = ForecastStore(target_time, variable, level, cache_dir=cache_dir)
+    series = []
+    for run_time in run_dates:
+        field = store.load_field(run_time)
+        if field is None:
             continue
+        j = int(np.abs(field['latitude'] - lat).argmin())
+        i = int(np.abs(field['longitude'] - lon).argmin())
+        series.append((run_time, float(field['values'][j, i])))
+    return series
+
+
+def plot_rmse_evolution(run_dates, rmses, variable_name):
+    """Crea il grafico RMSE rispetto all'ultimo run"""
     
-    if len(rmses) < 2:
-        print("❌ Non abbastanza RMSE calcolati")
-        return None
-    
-    # Crea plot
     fig, ax = plt.subplots(figsize=(10, 4))
     
     ax.plot(run_dates, rmses, 'o-', linewidth=2, markersize=6, 
@@ -415,5 +524,4 @@ def create_rmse_analysis(datasets, target_time, variable_name):
     plt.xticks(rotation=45)
     plt.tight_layout()
     
-    print(f"✅ RMSE calcolato per {len(rmses)} run")
-    return fig
\ No newline at end of file
+    return fig
@@ -1,7 +1,18 @@
 import streamlit as st
 from datetime import datetime, timedelta
 import os
-from animation_creator import create_forecast_evolution_animation, create_rmse_analysis
+from animation_creator import create_forecast_evolution_stream, plot_rmse_evolution, point_series
+from grib_archive import open_archive
+from cache_manager import CacheManager
+from shared_cache import get_backend
+from artifact_server import ArtifactStore, artifact_url, start_artifact_server, ARTIFACT_URL_ENV, CONTENT_TYPES
+from profiling import ProfileSession
+from contextlib import nullcontext
+import io
+import csv
+import json
+import uuid
+from urllib.parse import quote
 import time
 
 # Configurazione pagina
@@ -26,6 +37,131 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def get_cache_manager():
+    """Un solo gestore della cache per processo, con eviction in background"""
+    max_gb = float(os.environ.get('METEO_CACHE_MAX_GB', '2'))
+    # Storico massimo (7 giorni) + margine: i run ancora selezionabili non scadono
+    manager = CacheManager(archive=open_archive('gfs_archive'),
+                           cache_dir=get_backend().local_path('') or 'cache',
+                           max_bytes=int(max_gb * 1024 ** 3), max_age_days=8)
+    # GIF per sessione: gestite dal budget anche quelle rimaste da un avvio precedente
+    os.makedirs('animations', exist_ok=True)
+    manager.register_dir('animations')
+    # Profili delle generazioni (debug): snapshot tracemalloc anche di decine di MB
+    os.makedirs('profiles', exist_ok=True)
+    manager.register_dir('profiles')
+    return manager.start()
+
+
+cache_manager = get_cache_manager()
+
+
+# Servita da Streamlit su /app/static/ (server.enableStaticServing in .streamlit/config.toml)
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_ARTIFACTS_URL = '/app/static/artifacts'
+
+
+@st.cache_resource
+def get_artifact_store():
+    """
+    Artefatti per hash di contenuto. Con METEO_ARTIFACT_URL li serve il server
+    HTTP dalla cache condivisa, altrimenti Streamlit stesso da static/artifacts.
+    """
+    if os.environ.get(ARTIFACT_URL_ENV):
+        root = os.path.join(get_backend().local_path('') or 'cache', 'artifacts')
+        start_artifact_server(root)
+    else:
+        root = os.path.join(STATIC_DIR, 'artifacts')
+    cache_manager.register_dir(root)
+    return ArtifactStore(root)
+
+
+artifact_store = get_artifact_store()
+
+# Punto per la serie temporale delle previsioni
+POINT_NAME, POINT_LAT, POINT_LON = 'Torino', 45.07, 7.69
+
+
+def to_csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def publish_artifacts(stats, target, var_code, level):
+    """Pubblica GIF, tabella RMSE e serie sul punto; restituisce i nomi degli artefatti"""
+    runs = [run.strftime('%Y-%m-%d %H:00') for run in stats['run_dates']]
+    leads = [int((target - run).total_seconds() // 3600) for run in stats['run_dates']]
+    series = point_series(target, var_code, level, stats['run_dates'], POINT_LAT, POINT_LON)
+    series_rows = [(run.strftime('%Y-%m-%d %H:00'), round(value, 3)) for run, value in series]
+    return {
+        'gif': artifact_store.put_file(stats['output_file'], 'gif'),
+        'rmse_csv': artifact_store.put_bytes(
+            to_csv(['run', 'ore_prima', 'rmse'], zip(runs, leads, stats['rmses'])), 'csv'),
+        'rmse_json': artifact_store.put_bytes(json.dumps(
+            [{'run': run, 'ore_prima': lead, 'rmse': rmse}
+             for run, lead, rmse in zip(runs, leads, stats['rmses'])]).encode('utf-8'), 'json'),
+        'point_csv': artifact_store.put_bytes(to_csv(['run', var_code], series_rows), 'csv'),
+        'point_json': artifact_store.put_bytes(json.dumps({
+            'punto': POINT_NAME, 'lat': POINT_LAT, 'lon': POINT_LON, 'variabile': var_code,
+            'target': target.strftime('%Y-%m-%d %H:00'),
+            'serie': [{'run': run, 'valore': value} for run, value in series_rows],
+        }).encode('utf-8'), 'json'),
+    }
+
+
+def artifact_src(name):
+    """URL dell'artefatto per il browser, stessa origine dell'app se non c'è il server artefatti"""
+    return artifact_url(name) or f"{STATIC_ARTIFACTS_URL}/{name}"
+
+
+def artifact_available(name):
+    """L'artefatto è ancora su disco (il budget della cache può averlo eliminato)"""
+    path = artifact_store.path(name)
+    if path is None or not os.path.exists(path):
+        return False
+    cache_manager.touch(path)
+    return True
+
+
+def _read_artifact(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return b''
+
+
+def artifact_download(name, label, filename):
+    """
+    Pulsante di download: link al server artefatti se configurato, altrimenti
+    il file si legge solo al click (nessun byte passa da Streamlit ai rerun).
+    """
+    if not artifact_available(name):
+        st.caption(f"{label}: non più in cache, rigenera l'animazione")
+        return
+    url = artifact_url(name)
+    if url:
+        st.link_button(label, f"{url}?download={quote(filename)}")
+        return
+    path = artifact_store.path(name)
+    st.download_button(label, lambda: _read_artifact(path), file_name=filename,
+                       mime=CONTENT_TYPES[name.rsplit('.', 1)[1]], on_click='ignore',
+                       key=f"download_{name}")
+
+
+def publish_profile(session):
+    """Tempi per fase, hot spot e file del profilo (scaricabili come artefatti)"""
+    report = {'dir': session.output_dir, 'stages': session.stages, 'hot_spots': session.hot_spots(25)}
+    report['prof'] = artifact_store.put_file(os.path.join(session.output_dir, 'pipeline.prof'), 'prof')
+    folded = os.path.join(session.output_dir, 'stacks.folded')
+    if os.path.exists(folded):
+        report['folded'] = artifact_store.put_file(folded, 'folded')
+    return report
+
 # Header
 st.title("🌦️ Dashboard Previsioni Meteo - Piemonte")
 st.markdown("Evoluzione delle previsioni GFS per un momento target")
@@ -35,6 +171,14 @@ if 'rmse_fig' not in st.session_state:
     st.session_state.rmse_fig = None
 if 'last_generation' not in st.session_state:
     st.session_state.last_generation = None
+if 'artifacts' not in st.session_state:
+    st.session_state.artifacts = None
+if 'profile' not in st.session_state:
+    st.session_state.profile = None
+if 'gif_path' not in st.session_state:
+    # Un file per sessione: sessioni e repliche non si sovrascrivono la GIF.
+    # I dati dietro (campi, frame, animazioni) stanno nella cache condivisa.
+    st.session_state.gif_path = os.path.join('animations', f"forecast_{uuid.uuid4().hex[:12]}.gif")
 
 # Sidebar con controlli
 st.sidebar.header("⚙️ Configurazione")
@@ -92,6 +236,22 @@ with st.sidebar.expander("📖 Legenda Variabili"):
     - **Temperatura 850/500hPa**: Temperatura a diverse quote
     """)
 
+with st.sidebar.expander("🗄️ Cache"):
+    cache_stats = cache_manager.stats()
+    st.markdown(f"""
+    - **Hit / miss**: {cache_stats.get('hit', 0)} / {cache_stats.get('miss', 0)}
+    - **Occupata**: {cache_stats.get('bytes_cached', 0) / 1024 ** 2:.1f} MB
+    - **Eliminati**: {cache_stats.get('evict', 0)} ({cache_stats.get('bytes_evicted', 0) / 1024 ** 2:.1f} MB)
+    """)
+
+with st.sidebar.expander("🐞 Debug"):
+    # Solo per la prossima generazione di questa sessione: cProfile rallenta la pipeline
+    profile_enabled = st.checkbox("Profila la generazione", value=False)
+    profile_memory = st.checkbox("Allocazioni per fase (tracemalloc)", value=False,
+                                 disabled=not profile_enabled)
+    profile_sampling = st.checkbox("Stack campionati (flamegraph)", value=False,
+                                   disabled=not profile_enabled)
+
 # Main content area
 col1, col2, col3 = st.columns([1, 1, 1])
 
@@ -119,7 +279,7 @@ with col3:
 st.markdown("---")
 
 # Area principale per la GIF
-gif_path = 'current_forecast.gif'
+gif_path = st.session_state.gif_path
 
 if update_button:
     # Combina data e ora
@@ -139,24 +299,37 @@ if update_button:
             status_text.text("📥 Download run GFS...")
             progress_bar.progress(30)
             
-            # MODIFICA: Ora la funzione restituisce sia anim che datasets
-            anim, datasets = create_forecast_evolution_animation(
-                target_time=target,
-                days_back=days_back,
-                variable=var_code,
-                level=level,
-                output_file=gif_path
-            )
+            profiler = (ProfileSession('profiles', label=var_code, memory=profile_memory,
+                                       sampling=profile_sampling)
+                        if profile_enabled else nullcontext())
+            
+            # Pipeline streaming: restituisce solo le statistiche, nessun dataset resta in memoria
+            with profiler:
+                stats = create_forecast_evolution_stream(
+                    target_time=target,
+                    days_back=days_back,
+                    variable=var_code,
+                    level=level,
+                    output_file=gif_path,
+                    cache_manager=cache_manager
+                )
+            st.session_state.profile = publish_profile(profiler) if profile_enabled else None
             
             progress_bar.progress(70)
             status_text.text("📊 Generazione analisi RMSE...")
             
             # Crea il plot RMSE e salvalo in session state
-            st.session_state.rmse_fig = create_rmse_analysis(
-                datasets=datasets,
-                target_time=target,
-                variable_name=var_code
-            )
+            if len(stats['rmses']) >= 2:
+                st.session_state.rmse_fig = plot_rmse_evolution(
+                    stats['run_dates'], stats['rmses'], var_code
+                )
+            else:
+                st.session_state.rmse_fig = None
+            
+            # Gli artefatti si leggono una volta qui; ai rerun la pagina usa solo gli URL
+            st.session_state.artifacts = publish_artifacts(stats, target, var_code, level)
+            st.session_state.gif_size = os.path.getsize(stats['output_file'])
+            st.session_state.data_name = f"{target_date}_{var_code}"
             
             # Salva timestamp generazione
             st.session_state.last_generation = datetime.now()
@@ -179,12 +352,16 @@ if update_button:
 # Visualizza la GIF
 st.subheader("📊 Evoluzione della Previsione")
 
-if os.path.exists(gif_path):
-    # Mostra la GIF
+if st.session_state.artifacts is not None:
+    artifacts = st.session_state.artifacts
+    # Mostra la GIF per URL (cache del browser): il file non passa dalla sessione Streamlit
     col_gif, col_info = st.columns([2, 1])
     
     with col_gif:
-        st.image(gif_path, width='stretch')
+        if artifact_available(artifacts['gif']):
+            st.image(artifact_src(artifacts['gif']), width='stretch')
+        else:
+            st.warning("⚠️ L'animazione non è più in cache: clicca su 'Genera Animazione' per rigenerarla")
     
     with col_info:
         st.info("""
@@ -197,21 +374,28 @@ if os.path.exists(gif_path):
         """)
         
         # Info sul file
-        file_size = os.path.getsize(gif_path) / 1024  # KB
+        file_size = st.session_state.gif_size / 1024  # KB
         st.caption(f"Dimensione file: {file_size:.1f} KB")
         
         # Info ultima generazione
         if st.session_state.last_generation:
             st.caption(f"Ultima generazione: {st.session_state.last_generation.strftime('%H:%M:%S')}")
         
-        # Download button
-        with open(gif_path, 'rb') as f:
-            st.download_button(
-                label="⬇️ Scarica GIF",
-                data=f,
-                file_name=f"previsione_{target_date}_{var_code}.gif",
-                mime="image/gif"
-            )
+        # Download e dati: link al server artefatti o file letti solo al click
+        data_name = st.session_state.data_name
+        artifact_download(artifacts['gif'], "⬇️ Scarica GIF", f"previsione_{data_name}.gif")
+        st.markdown("📄 **RMSE**")
+        col_csv, col_json = st.columns(2)
+        with col_csv:
+            artifact_download(artifacts['rmse_csv'], "CSV", f"rmse_{data_name}.csv")
+        with col_json:
+            artifact_download(artifacts['rmse_json'], "JSON", f"rmse_{data_name}.json")
+        st.markdown(f"📍 **Serie su {POINT_NAME}**")
+        col_csv, col_json = st.columns(2)
+        with col_csv:
+            artifact_download(artifacts['point_csv'], "CSV", f"serie_{POINT_NAME.lower()}_{data_name}.csv")
+        with col_json:
+            artifact_download(artifacts['point_json'], "JSON", f"serie_{POINT_NAME.lower()}_{data_name}.json")
     
     # SEZIONE AGGIUNTA: Visualizza analisi RMSE
     st.markdown("---")
@@ -240,6 +424,25 @@ if os.path.exists(gif_path):
             """)
     else:
         st.warning("Analisi RMSE non disponibile. Rigenera l'animazione.")
+    
+    if st.session_state.profile is not None:
+        profile = st.session_state.profile
+        with st.expander("🔬 Profilo dell'ultima generazione", expanded=True):
+            st.markdown("**⏱️ Tempi per fase**")
+            st.dataframe([{key: value for key, value in stage.items()
+                           if key not in ('top_allocations', 'snapshot')}
+                          for stage in profile['stages']], hide_index=True)
+            st.markdown("**🔥 Hot spot** (tempo proprio, thread della pipeline)")
+            st.dataframe(profile['hot_spots'], hide_index=True)
+            allocations = [dict(allocation, stage=stage['stage'])
+                           for stage in profile['stages'] for allocation in stage.get('top_allocations', [])]
+            if allocations:
+                st.markdown("**🧠 Allocazioni principali a fine fase**")
+                st.dataframe(allocations, hide_index=True)
+            artifact_download(profile['prof'], "📄 pipeline.prof", "pipeline.prof")
+            if 'folded' in profile:
+                artifact_download(profile['folded'], "📄 stacks.folded", "stacks.folded")
+            st.caption(f"📁 {profile['dir']}")
         
 else:
     st.info("👆 Clicca su 'Genera Animazione' per creare la visualizzazione")
@@ -0,0 +1,197 @@
+import os
+import re
+import sys
+import errno
+import hashlib
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ARTIFACT_PORT_ENV = 'METEO_ARTIFACT_PORT'
+# URL del server raggiungibile dal browser (porta inoltrata, reverse proxy, ...)
+ARTIFACT_URL_ENV = 'METEO_ARTIFACT_URL'
+DEFAULT_PORT = 8502
+
+CONTENT_TYPES = {
+    'gif': 'image/gif',
+    'json': 'application/json',
+    'csv': 'text/csv; charset=utf-8',
+    # Profili della pipeline (profiling.py): pstats e stack per flamegraph
+    'prof': 'application/octet-stream',
+    'folded': 'text/plain; charset=utf-8',
+}
+
+# Nome = hash del contenuto + estensione: lo stesso nome ha sempre gli stessi byte
+_NAME = re.compile(r'^(?P<digest>[0-9a-f]{32})\.(?P<ext>[a-z]+)$')
+_RANGE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+_CHUNK = 64 * 1024
+
+
+class ArtifactStore:
+    """
+    Artefatti immutabili indirizzati per contenuto (<sha256>.<ext>) in una
+    cartella: animazioni, tabelle RMSE, serie su punto. Pubblicare due volte
+    lo stesso contenuto non riscrive nulla.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        match = _NAME.match(name)
+        if not match or match['ext'] not in CONTENT_TYPES:
+            return None
+        return os.path.join(self.root, name)
+
+    def put_bytes(self, data, ext):
+        """Pubblica dei byte, restituisce il nome dell'artefatto"""
+        name = f"{hashlib.sha256(data).hexdigest()[:32]}.{ext}"
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return name
+
+    def put_file(self, path, ext):
+        with open(path, 'rb') as f:
+            return self.put_bytes(f.read(), ext)
+
+
+def artifact_url(name):
+    """
+    URL pubblico dell'artefatto, None se METEO_ARTIFACT_URL non è impostato:
+    localhost del server non è raggiungibile dal browser di un utente remoto.
+    """
+    base = os.environ.get(ARTIFACT_URL_ENV)
+    if not base:
+        return None
+    return f"{base.rstrip('/')}/artifacts/{name}"
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    """GET/HEAD /artifacts/<nome> con ETag, Cache-Control immutable e Range"""
+
+    store = None
+    server_version = 'MeteoArtifacts/1.0'
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        prefix = '/artifacts/'
+        name, _, query = self.path.partition('?')
+        path = self.store.path(name[len(prefix):]) if name.startswith(prefix) else None
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        digest, ext = os.path.basename(path).split('.', 1)
+        etag = f'"{digest}"'
+        size = os.path.getsize(path)
+
+        # Il contenuto non cambia mai: basta confrontare l'ETag
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self._common_headers(etag)
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            match = _RANGE.match(range_header.strip())
+            # Un intervallo con fine < inizio non è valido: si ignora e si manda tutto (200)
+            if match and match['start'] and match['end'] and int(match['end']) < int(match['start']):
+                match = None
+            if match and (match['start'] or match['end']):
+                if match['start']:
+                    start = int(match['start'])
+                    end = min(int(match['end']), size - 1) if match['end'] else size - 1
+                else:
+                    # bytes=-N: gli ultimi N byte
+                    start = max(size - int(match['end']), 0)
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{size}")
+                    self._common_headers(etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+
+        self.send_response(status)
+        self._common_headers(etag)
+        self.send_header('Content-Type', CONTENT_TYPES[ext])
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        download = parse_qs(query).get('download')
+        if download:
+            filename = re.sub(r'[^A-Za-z0-9._-]', '_', download[0])
+            self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.end_headers()
+
+        if send_body:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+    def _common_headers(self, etag):
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Access-Control-Allow-Origin', '*')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_artifact_server(root, host='0.0.0.0', port=None):
+    """
+    Avvia il server in un thread daemon. Se la porta è già occupata (es. da
+    un altro worker sulla stessa cartella) restituisce None: basta quello.
+    """
+    port = port or int(os.environ.get(ARTIFACT_PORT_ENV, DEFAULT_PORT))
+    handler = type('Handler', (ArtifactHandler,), {'store': ArtifactStore(root)})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        if e.errno == errno.EADDRINUSE:
+            print(f"ℹ️ Porta {port} già in uso: uso il server artefatti esistente")
+            return None
+        raise
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='artifact-server', daemon=True).start()
+    print(f"✓ Server artefatti su http://{host}:{port}/artifacts/")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Server HTTP degli artefatti generati")
+    parser.add_argument('--root', default=os.path.join('cache', 'artifacts'))
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args()
+
+    port = args.port or int(os.environ.get(ARTIFACT_PORT_ENV, DEFAULT_PORT))
+    handler = type('Handler', (ArtifactHandler,), {'store': ArtifactStore(args.root)})
+    print(f"✓ Server artefatti su http://{args.host}:{port}/artifacts/ ({args.root})")
+    sys.stdout.flush()
+    ThreadingHTTPServer((args.host, port), handler).serve_forever()
@@ -0,0 +1,279 @@
+import os
+import re
+import time
+import fcntl
+import shutil
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# Cartelle di ForecastStore: <VAR>_<livello>_<YYYYMMDDHH del target>
+_STORE_DIR = re.compile(r'_(?P<target>\d{10})$')
+
+
+def _path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class CacheManager:
+    """
+    Budget su disco e retention per i dati scaricati e derivati:
+    - cicli dell'archivio GRIB (GribArchive), età = ora del run
+    - cartelle ForecastStore (campi, frame, contorni), età = ora del target
+    - animazioni registrate con register_file
+    - file e sottocartelle delle cartelle registrate con register_dir
+      (es. artefatti HTTP, profili)
+
+    Oltre max_age_days le voci vengono eliminate; oltre max_bytes si
+    eliminano le meno usate di recente (LRU). Le voci in uso vanno
+    protette con pin(). L'eviction gira in un thread in background:
+    i thread delle richieste chiamano solo request_eviction().
+
+    Con la cache condivisa tra repliche i pin valgono anche tra processi:
+    il thread di ogni processo rinnova l'mtime dei suoi percorsi in uso e
+    nessuno elimina voci usate negli ultimi pin_ttl secondi. Un passaggio
+    di eviction alla volta, su tutte le repliche (flock).
+    """
+
+    def __init__(self, archive=None, cache_dir='cache', max_bytes=2 * 1024 ** 3,
+                 max_age_days=7, interval=600, pin_ttl=120):
+        self.archive = archive
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.pin_ttl = pin_ttl
+
+        self.counters = Counter()
+        self._pins = Counter()
+        self._files = set()
+        self._dirs = set()
+        self._lock = threading.Lock()
+        # Voci in corso di rimozione: pin() su quelle chiavi aspetta che finisca
+        self._evicting = set()
+        self._evicted = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- Uso dalle richieste ---
+
+    @contextmanager
+    def pin(self, *paths):
+        """Impedisce l'eviction dei percorsi indicati finché il blocco è attivo"""
+        keys = [os.path.abspath(path) for path in paths]
+        with self._lock:
+            while self._evicting.intersection(keys):
+                self._evicted.wait()
+            self._pins.update(keys)
+        # L'mtime recente protegge i percorsi anche dall'eviction di altri processi
+        for path in paths:
+            self.touch(path)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins.subtract(keys)
+                self._pins += Counter()  # rimuove i contatori a zero
+            for path in paths:
+                self.touch(path)
+
+    def touch(self, path):
+        """Segna un percorso come appena usato (mtime, valido anche tra processi)"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def record(self, event, n=1):
+        """Aggiorna i contatori: 'hit', 'miss', ..."""
+        with self._lock:
+            self.counters[event] += n
+
+    def register_file(self, path):
+        """Aggiunge un output (es. GIF) a quelli gestiti dal budget"""
+        with self._lock:
+            self._files.add(os.path.abspath(path))
+
+    def register_dir(self, path):
+        """Aggiunge una cartella i cui file (o sottocartelle) sono gestiti singolarmente dal budget"""
+        with self._lock:
+            self._dirs.add(os.path.abspath(path))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def request_eviction(self):
+        """Chiede un passaggio di eviction al thread in background, senza attendere"""
+        self._wakeup.set()
+
+    # --- Thread in background ---
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='cache-eviction', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        last = None
+        while not self._stop.is_set():
+            self._heartbeat()
+            if last is None or self._wakeup.is_set() or time.time() - last >= self.interval:
+                self._wakeup.clear()
+                try:
+                    self.evict()
+                except Exception as e:
+                    print(f"⚠️ Errore eviction cache: {e}")
+                last = time.time()
+            self._wakeup.wait(self.pin_ttl / 2)
+
+    def _heartbeat(self):
+        """Rinnova l'mtime dei percorsi in uso: per gli altri processi valgono come pin"""
+        with self._lock:
+            pinned = list(self._pins)
+        for path in pinned:
+            self.touch(path)
+
+    # --- Eviction ---
+
+    def _entries(self):
+        """Voci gestite: (chiave, byte, ultimo uso, istante di riferimento, rimozione)"""
+        entries = []
+
+        if self.archive is not None:
+            for run_time in self.archive.cycles():
+                files = [path for path in self.archive.cycle_files(run_time) if os.path.exists(path)]
+                if not files:
+                    continue
+                entries.append((
+                    os.path.abspath(files[0]),
+                    sum(os.path.getsize(path) for path in files),
+                    max(os.path.getmtime(path) for path in files),
+                    run_time,
+                    lambda run_time=run_time: self.archive.remove_cycle(run_time),
+                ))
+
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                match = _STORE_DIR.search(name)
+                if not os.path.isdir(path) or not match:
+                    continue
+                entries.append((
+                    os.path.abspath(path),
+                    _path_size(path),
+                    os.path.getmtime(path),
+                    datetime.strptime(match['target'], '%Y%m%d%H'),
+                    lambda path=path: shutil.rmtree(path, ignore_errors=True),
+                ))
+
+        with self._lock:
+            files = set(self._files)
+            for directory in self._dirs:
+                if os.path.isdir(directory):
+                    # Un file registrato dentro una cartella registrata è una sola voce
+                    files.update(os.path.join(directory, name) for name in os.listdir(directory)
+                                 if not name.endswith('.tmp'))
+        for path in sorted(files):
+            if os.path.isdir(path):
+                remove_fn = lambda path=path: shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                remove_fn = lambda path=path: os.remove(path)
+            else:
+                continue
+            mtime = os.path.getmtime(path)
+            entries.append((path, _path_size(path), mtime,
+                            datetime.utcfromtimestamp(mtime), remove_fn))
+        return entries
+
+    def _last_used(self, key, last_used):
+        """mtime aggiornato (l'elenco delle voci può essere di qualche secondo fa)"""
+        try:
+            return max(last_used, os.path.getmtime(key))
+        except OSError:
+            return last_used
+
+    def evict(self, now=None):
+        """Un passaggio di retention + LRU; restituisce i byte liberati"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, '.eviction.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0  # un'altra replica sta già facendo eviction
+            try:
+                return self._evict(now)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _evict(self, now=None):
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(days=self.max_age_days) if self.max_age_days is not None else None
+        entries = self._entries()
+        total = sum(entry[1] for entry in entries)
+        freed = 0
+
+        def remove(entry, reason):
+            nonlocal total, freed
+            key, size, last_used, _, remove_fn = entry
+            # Usata di recente, forse da un'altra replica: mtime come pin tra processi
+            if time.time() - self._last_used(key, last_used) < self.pin_ttl:
+                return False
+            # Sotto lock si segna solo la chiave: la rimozione (anche lenta, es. NFS)
+            # non blocca le richieste, solo un pin() su questa chiave aspetta
+            with self._lock:
+                if self._pins[key] > 0:
+                    return False
+                self._evicting.add(key)
+            try:
+                remove_fn()
+            except OSError as e:
+                print(f"⚠️ Eviction fallita per {key}: {e}")
+                return False
+            finally:
+                with self._lock:
+                    self._evicting.discard(key)
+                    self._evicted.notify_all()
+            total -= size
+            freed += size
+            self.record('evict')
+            self.record(f'evict_{reason}')
+            self.record('bytes_evicted', size)
+            return True
+
+        # Retention: voci più vecchie del limite
+        remaining = []
+        for entry in entries:
+            if cutoff is not None and entry[3] < cutoff and remove(entry, 'age'):
+                continue
+            remaining.append(entry)
+
+        # Budget: LRU sulle voci rimaste
+        if self.max_bytes is not None and total > self.max_bytes:
+            for entry in sorted(remaining, key=lambda entry: entry[2]):
+                if total <= self.max_bytes:
+                    break
+                remove(entry, 'budget')
+
+        with self._lock:
+            self.counters['bytes_cached'] = total
+        return freed
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import contourpy
+from matplotlib.collections import LineCollection
+
+# Cache in memoria delle geometrie (chiave -> contorni), LRU condivisa dalle sessioni
+_MEMORY_CACHE = OrderedDict()
+_MEMORY_CACHE_SIZE = 256
+_MEMORY_LOCK = threading.Lock()
+
+
+def crop_field(field, xlim, ylim, margin=1):
+    """Ritaglia il campo all'area visualizzata più `margin` celle per lato"""
+    lon = field['longitude']
+    lat = field['latitude']
+
+    lon_idx = np.where((lon >= xlim[0]) & (lon <= xlim[1]))[0]
+    lat_idx = np.where((lat >= ylim[0]) & (lat <= ylim[1]))[0]
+    if lon_idx.size == 0 or lat_idx.size == 0:
+        return lon, lat, field['values']
+
+    i0 = max(lon_idx[0] - margin, 0)
+    i1 = min(lon_idx[-1] + margin + 1, lon.size)
+    j0 = max(lat_idx[0] - margin, 0)
+    j1 = min(lat_idx[-1] + margin + 1, lat.size)
+    return lon[i0:i1], lat[j0:j1], field['values'][j0:j1, i0:i1]
+
+
+def compute_contours(lon, lat, values, levels, xlim=None, ylim=None):
+    """
+    Calcola le isolinee (marching squares) e la posizione delle etichette.
+    Restituisce un dict con livelli, segmenti per livello ed etichette.
+    """
+    gen = contourpy.contour_generator(lon, lat, np.ma.masked_invalid(values),
+                                      line_type=contourpy.LineType.Separate)
+
+    segments = []
+    labels = []
+    for level in levels:
+        lines = [np.asarray(line, dtype=np.float32) for line in gen.lines(level) if len(line) > 1]
+        segments.append(lines)
+
+        # Etichetta sulla linea con più punti visibili, al centro del tratto visibile
+        best = None
+        for line in lines:
+            visible = np.ones(len(line), dtype=bool)
+            if xlim is not None:
+                visible &= (line[:, 0] >= xlim[0]) & (line[:, 0] <= xlim[1])
+            if ylim is not None:
+                visible &= (line[:, 1] >= ylim[0]) & (line[:, 1] <= ylim[1])
+            idx = np.flatnonzero(visible)
+            if idx.size and (best is None or idx.size > best[1].size):
+                best = (line, idx)
+        if best is None:
+            continue
+
+        line, idx = best
+        mid = idx[idx.size // 2]
+        p0 = line[max(mid - 1, 0)]
+        p1 = line[min(mid + 1, len(line) - 1)]
+        angle = np.degrees(np.arctan2(p1[1] - p0[1], p1[0] - p0[0]))
+        if angle > 90:
+            angle -= 180
+        elif angle < -90:
+            angle += 180
+        labels.append((float(line[mid][0]), float(line[mid][1]), float(level), float(angle)))
+
+    return {'levels': np.asarray(levels, dtype=np.float64), 'segments': segments, 'labels': labels}
+
+
+def _cache_key(values, levels, xlim, ylim):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(values).tobytes())
+    h.update(np.asarray(levels, dtype=np.float64).tobytes())
+    h.update(np.asarray(list(xlim) + list(ylim), dtype=np.float64).tobytes())
+    return h.hexdigest()[:20]
+
+
+def _save_contours(path, contours):
+    vertices = []
+    offsets = [0]
+    counts = []
+    for lines in contours['segments']:
+        counts.append(len(lines))
+        for line in lines:
+            vertices.append(line)
+            offsets.append(offsets[-1] + len(line))
+
+    tmp = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp,
+             levels=contours['levels'],
+             vertices=np.concatenate(vertices) if vertices else np.zeros((0, 2), dtype=np.float32),
+             offsets=np.asarray(offsets, dtype=np.int64),
+             counts=np.asarray(counts, dtype=np.int64),
+             labels=np.asarray(contours['labels'], dtype=np.float64).reshape(-1, 4))
+    os.replace(tmp, path)
+
+
+def _load_contours(path):
+    with np.load(path) as data:
+        vertices = data['vertices']
+        offsets = data['offsets']
+        segments = []
+        k = 0
+        for count in data['counts']:
+            segments.append([vertices[offsets[k + n]:offsets[k + n + 1]] for n in range(count)])
+            k += count
+        return {
+            'levels': data['levels'],
+            'segments': segments,
+            'labels': [tuple(row) for row in data['labels']],
+        }
+
+
+def get_contours(field, levels, xlim, ylim, cache_dir=None):
+    """
+    Isolinee del campo ritagliato, calcolate una volta per
+    (campo, livelli, ritaglio) e tenute in memoria e, se indicato,
+    su disco in cache_dir accanto al campo decodificato.
+    """
+    lon, lat, values = crop_field(field, xlim, ylim)
+    key = _cache_key(values, levels, xlim, ylim)
+
+    with _MEMORY_LOCK:
+        if key in _MEMORY_CACHE:
+            _MEMORY_CACHE.move_to_end(key)
+            return _MEMORY_CACHE[key]
+
+    contours = None
+    path = os.path.join(cache_dir, f"contours_{key}.npz") if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            contours = _load_contours(path)
+        except Exception as e:
+            print(f"    ⚠️ Contorni in cache illeggibili ({e}), li ricalcolo")
+
+    if contours is None:
+        contours = compute_contours(lon, lat, values, levels, xlim, ylim)
+        if path:
+            _save_contours(path, contours)
+
+    with _MEMORY_LOCK:
+        _MEMORY_CACHE[key] = contours
+        _MEMORY_CACHE.move_to_end(key)
+        if len(_MEMORY_CACHE) > _MEMORY_CACHE_SIZE:
+            _MEMORY_CACHE.popitem(last=False)
+    return contours
+
+
+def draw_contours(ax, contours, fmt='%d', color='black', linewidth=0.5, alpha=0.5, fontsize=8):
+    """Disegna isolinee ed etichette già calcolate, senza ricalcolarle"""
+    lines = [line for level_lines in contours['segments'] for line in level_lines]
+    if lines:
+        ax.add_collection(LineCollection(lines, colors=color, linewidths=linewidth, alpha=alpha))
+
+    for x, y, level, angle in contours['labels']:
+        ax.text(x, y, fmt % level, fontsize=fontsize, rotation=angle,
+                ha='center', va='center', clip_on=True,
+                bbox=dict(facecolor='white', edgecolor='none', alpha=0.6, pad=0.5))
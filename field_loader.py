@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+from scale import histogram_counts
+
+# Thread per le riduzioni: decodifica eccodes e NumPy rilasciano il GIL
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def open_forecast_runs(run_times, load_values, template, spatial_chunks=None):
+    """
+    DataArray pigro (run, latitude, longitude) con un chunk dask per run,
+    come xr.open_mfdataset(..., combine='nested', concat_dim='run').
+    load_values(run_time) viene chiamato solo quando il chunk serve davvero;
+    template è un campo già decodificato (griglia e dtype comuni a tutti i run).
+    """
+    values = template['values']
+    blocks = []
+    for run_time in run_times:
+        key = f"load-{run_time.strftime('%Y%m%d%H')}-{id(load_values):x}"
+        delayed = dask.delayed(load_values, pure=True)(run_time, dask_key_name=key)
+        blocks.append(da.from_delayed(delayed, shape=values.shape, dtype=values.dtype))
+
+    runs = xr.DataArray(
+        da.stack(blocks) if blocks else da.zeros((0,) + values.shape, dtype=values.dtype),
+        dims=('run', 'latitude', 'longitude'),
+        coords={
+            'run': np.array(run_times, dtype='datetime64[ns]'),
+            'latitude': template['latitude'],
+            'longitude': template['longitude'],
+        },
+    )
+    if spatial_chunks:
+        runs = runs.chunk({'latitude': spatial_chunks, 'longitude': spatial_chunks})
+    return runs
+
+
+def _window(runs, xlim, ylim):
+    """Ritaglio lazy (isel) all'area visualizzata"""
+    lon = runs['longitude'].values
+    lat = runs['latitude'].values
+    lon_idx = np.flatnonzero((lon >= xlim[0]) & (lon <= xlim[1]))
+    lat_idx = np.flatnonzero((lat >= ylim[0]) & (lat <= ylim[1]))
+    if lon_idx.size == 0 or lat_idx.size == 0:
+        return runs
+    return runs.isel(longitude=slice(lon_idx[0], lon_idx[-1] + 1),
+                     latitude=slice(lat_idx[0], lat_idx[-1] + 1))
+
+
+def compute_run_statistics(runs, reference, sketch=None, xlim=None, ylim=None,
+                           num_workers=DEFAULT_WORKERS):
+    """
+    RMSE rispetto al riferimento, minimo e massimo di ogni run, calcolati
+    chunk per chunk in parallelo con lo scheduler a thread locale.
+    Con uno sketch vuoto (QuantileSketch) calcola nello stesso passaggio
+    anche l'istogramma di ogni run, ritagliato a xlim/ylim se indicati.
+    Restituisce {run_time: {'rmse', 'min', 'max', 'sketch'}}.
+    """
+    if runs.sizes['run'] == 0:
+        return {}
+
+    spatial = ('latitude', 'longitude')
+    ref = xr.DataArray(reference, dims=spatial)
+    rmse = np.sqrt(((runs - ref) ** 2).mean(spatial, skipna=True))
+    tasks = [rmse.data, runs.min(spatial, skipna=True).data, runs.max(spatial, skipna=True).data]
+
+    if sketch is not None:
+        area = _window(runs, xlim, ylim) if xlim is not None and ylim is not None else runs
+        counts = xr.apply_ufunc(
+            lambda block: np.stack([histogram_counts(field, sketch.lo, sketch.hi, sketch.bins)
+                                    for field in block]),
+            area, input_core_dims=[spatial], output_core_dims=[['bin']],
+            dask='parallelized', output_dtypes=[np.int64],
+            dask_gufunc_kwargs={'output_sizes': {'bin': sketch.bins}, 'allow_rechunk': True})
+        tasks.append(counts.data)
+
+    results = dask.compute(*tasks, scheduler='threads', num_workers=num_workers)
+
+    stats = {}
+    for i, run_time in enumerate(t.to_pydatetime() for t in runs.indexes['run']):
+        stats[run_time] = {
+            'rmse': float(results[0][i]),
+            'min': float(results[1][i]),
+            'max': float(results[2][i]),
+            'sketch': sketch.empty().add_counts(results[3][i]) if sketch is not None else None,
+        }
+    return stats
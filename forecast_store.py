@@ -0,0 +1,206 @@
+import io
+import os
+import json
+import time
+import struct
+import numpy as np
+import pandas as pd
+from scale import QuantileSketch
+from shared_cache import get_backend, single_flight
+
+
+def _run_key(run_time):
+    return run_time.strftime('%Y%m%d%H')
+
+
+class ForecastStore:
+    """
+    Cache condivisa (CacheBackend) per una coppia (target, variabile, livello):
+    - fields/<run>.npz       campo decodificato di ogni run
+    - frames/<stile>/<run>.gifblock  frame già codificato per la GIF
+    - animations/<chiave>.gif/.json  animazione finita e sue statistiche
+    - meta.json              RMSE per run, run di riferimento usato,
+                             sketch dei quantili di ogni run e scala
+                             adattiva fissata per il target
+    Al refresh si scaricano e disegnano solo i run nuovi; tra processi e
+    repliche ogni campo mancante viene decodificato una volta sola.
+    """
+
+    def __init__(self, target_time, variable, level, cache_dir=None, backend=None):
+        self.target_time = target_time
+        self.backend = backend or get_backend(cache_dir)
+        self.name = f"{variable}_{level}_{_run_key(target_time)}"
+        # Percorsi locali (None se il backend non è su disco): pin dell'eviction e contorni
+        self.cache_dir = self.backend.local_path('')
+        self.root = self.backend.local_path(self.name)
+        self.fields_dir = self.backend.local_path(f"{self.name}/fields")
+        if self.fields_dir:
+            os.makedirs(self.fields_dir, exist_ok=True)
+        self.meta = self._load_meta()
+
+    def _key(self, *parts):
+        return '/'.join((self.name,) + parts)
+
+    def lock(self, *parts):
+        return self.backend.lock(self._key(*parts))
+
+    # --- Campi decodificati ---
+
+    def _field_key(self, run_time):
+        return self._key('fields', f"{_run_key(run_time)}.npz")
+
+    def has_field(self, run_time):
+        return self.backend.exists(self._field_key(run_time))
+
+    def load_field(self, run_time):
+        data = self.backend.get(self._field_key(run_time))
+        if data is None:
+            return None
+        try:
+            with np.load(io.BytesIO(data)) as npz:
+                return {
+                    'values': npz['values'],
+                    'latitude': npz['latitude'],
+                    'longitude': npz['longitude'],
+                    'valid_time': pd.Timestamp(int(npz['valid_time']), unit='ns'),
+                }
+        except Exception as e:
+            print(f"    ⚠️ Campo in cache illeggibile ({e}), lo riscarico")
+            return None
+
+    def save_field(self, run_time, field):
+        buffer = io.BytesIO()
+        np.savez(buffer, values=field['values'], latitude=field['latitude'],
+                 longitude=field['longitude'], valid_time=np.int64(field['valid_time'].value))
+        self.backend.put(self._field_key(run_time), buffer.getvalue())
+
+    def get_field(self, run_time, decode):
+        """
+        Campo dalla cache o, se manca, decode(run_time) salvato in cache:
+        tra processi concorrenti la decodifica avviene una volta sola.
+        Restituisce (campo, decodificato_qui).
+        """
+        def compute():
+            field = decode(run_time)
+            self.save_field(run_time, field)
+            return field
+        return single_flight(self.backend, self._field_key(run_time),
+                             lambda: self.load_field(run_time), compute)
+
+    # --- Frame codificati ---
+
+    def _frame_key(self, run_time, style):
+        return self._key('frames', style, f"{_run_key(run_time)}.gifblock")
+
+    def lock_frame(self, run_time, style):
+        return self.backend.lock(self._frame_key(run_time, style))
+
+    def load_frame(self, run_time, style):
+        """Restituisce (blocco GIF, dimensione) oppure None"""
+        data = self.backend.get(self._frame_key(run_time, style))
+        if data is None or len(data) < 8:
+            return None
+        width, height = struct.unpack('<II', data[:8])
+        return data[8:], (width, height)
+
+    def save_frame(self, run_time, style, block, size):
+        # La dimensione sta in testa al blocco: nessuno stato condiviso in meta.json
+        self.backend.put(self._frame_key(run_time, style), struct.pack('<II', *size) + block)
+
+    # --- Animazioni finite ---
+
+    def load_animation(self, key, incomplete_ttl=600):
+        """
+        Restituisce (byte della GIF, statistiche) oppure None. Un'animazione
+        a cui mancavano dei run (download falliti, run non ancora pubblicati)
+        vale solo per incomplete_ttl secondi.
+        """
+        info = self.backend.get(self._key('animations', f"{key}.json"))
+        if info is None:
+            return None
+        info = json.loads(info)
+        if not info.pop('complete', True) and time.time() - info.get('created', 0) > incomplete_ttl:
+            return None
+        info.pop('created', None)
+        data = self.backend.get(self._key('animations', f"{key}.gif"))
+        if data is None:
+            return None
+        return data, info
+
+    def save_animation(self, key, data, info, complete=True):
+        # Prima la GIF, poi le statistiche: chi trova il .json trova anche la GIF
+        self.backend.put(self._key('animations', f"{key}.gif"), data)
+        info = dict(info, complete=complete, created=time.time())
+        self.backend.put(self._key('animations', f"{key}.json"), json.dumps(info).encode('utf-8'))
+
+    def get_animation(self, key, generate):
+        """
+        (byte della GIF, statistiche) dalla cache o da generate(), che restituisce
+        (byte, statistiche, completa): una replica alla volta genera.
+        Restituisce ((byte, statistiche), generata_qui).
+        """
+        def compute():
+            data, info, complete = generate()
+            self.save_animation(key, data, info, complete)
+            return data, info
+        return single_flight(self.backend, self._key('animations', f"{key}.gif"),
+                             lambda: self.load_animation(key), compute)
+
+    # --- Statistiche dipendenti dal riferimento ---
+
+    def cached_rmses(self, reference_run):
+        """RMSE già calcolati, validi solo se il riferimento non è cambiato"""
+        if self.meta.get('reference') != _run_key(reference_run):
+            return {}
+        return self.meta.get('rmses', {})
+
+    def set_rmses(self, reference_run, rmses):
+        self.meta['reference'] = _run_key(reference_run)
+        self.meta['rmses'] = {_run_key(run): rmse for run, rmse in rmses.items()}
+
+    # --- Sketch dei quantili (indipendenti dal riferimento) ---
+
+    def load_sketch(self, run_time):
+        data = self.meta.get('sketches', {}).get(_run_key(run_time))
+        return QuantileSketch.from_dict(data) if data else None
+
+    def load_sketches(self):
+        return {run: QuantileSketch.from_dict(data)
+                for run, data in self.meta.get('sketches', {}).items()}
+
+    def set_sketch(self, run_time, sketch):
+        self.meta.setdefault('sketches', {})[_run_key(run_time)] = sketch.to_dict()
+
+    # --- Scala adattiva (fissata al primo calcolo) ---
+
+    def load_scale(self):
+        scale = self.meta.get('scale')
+        return tuple(scale) if scale else None
+
+    def set_scale(self, vmin, vmax):
+        self.meta['scale'] = [float(vmin), float(vmax)]
+
+    def save_meta(self):
+        """Salva unendo quanto scritto nel frattempo da altri processi"""
+        with self.lock('meta.json'):
+            current = self._load_meta()
+            sketches = current.get('sketches', {})
+            sketches.update(self.meta.get('sketches', {}))
+            self.meta['sketches'] = sketches
+            # La scala è di chi l'ha salvata per primo: i suoi frame sono già in cache
+            if current.get('scale'):
+                self.meta['scale'] = current['scale']
+            if current.get('reference') == self.meta.get('reference'):
+                rmses = current.get('rmses', {})
+                rmses.update(self.meta.get('rmses', {}))
+                self.meta['rmses'] = rmses
+            self.backend.put(self._key('meta.json'), json.dumps(self.meta).encode('utf-8'))
+
+    def _load_meta(self):
+        data = self.backend.get(self._key('meta.json'))
+        if data is None:
+            return {}
+        try:
+            return json.loads(data)
+        except Exception:
+            return {}
@@ -0,0 +1,259 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from contour_cache import draw_contours
+
+# Cache dei layer statici: chiave -> (sotto, sopra, aspect, box assi in pixel)
+_STATIC_LAYERS = OrderedDict()
+_STATIC_LAYERS_SIZE = 8
+_STATIC_LAYERS_LOCK = threading.Lock()
+# Un lock per chiave in preparazione: due sessioni non disegnano lo stesso layer
+_STATIC_LAYERS_BUILDING = {}
+
+
+def _static_layers(key, build):
+    """Layer statici dalla cache o da build(), calcolati una volta per chiave"""
+    with _STATIC_LAYERS_LOCK:
+        if key in _STATIC_LAYERS:
+            _STATIC_LAYERS.move_to_end(key)
+            return _STATIC_LAYERS[key]
+        key_lock = _STATIC_LAYERS_BUILDING.setdefault(key, threading.Lock())
+    with key_lock:
+        with _STATIC_LAYERS_LOCK:
+            if key in _STATIC_LAYERS:
+                _STATIC_LAYERS.move_to_end(key)
+                return _STATIC_LAYERS[key]
+        try:
+            layers = build()
+            with _STATIC_LAYERS_LOCK:
+                _STATIC_LAYERS[key] = layers
+                if len(_STATIC_LAYERS) > _STATIC_LAYERS_SIZE:
+                    _STATIC_LAYERS.popitem(last=False)
+            return layers
+        finally:
+            with _STATIC_LAYERS_LOCK:
+                _STATIC_LAYERS_BUILDING.pop(key, None)
+
+
+def _build_figure(config, vmin, vmax, figsize, xlim, ylim, dpi, aspect='auto'):
+    """Figura con lo stesso layout per layer statici e dinamici"""
+    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    ax.set_aspect(aspect)
+    cbar = plt.colorbar(plt.cm.ScalarMappable(cmap=config['cmap'],
+                        norm=plt.Normalize(vmin=vmin, vmax=vmax)),
+                        ax=ax, label=config['label'])
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    ax.set_xlabel('Longitudine')
+    ax.set_ylabel('Latitudine')
+    return fig, ax, cbar
+
+
+def _to_rgba(fig):
+    fig.canvas.draw()
+    return np.array(fig.canvas.buffer_rgba())
+
+
+def build_colormap_lut(cmap_name, n=256):
+    """
+    Tabella RGBA uint8 della colormap con n colori (opachi), più un colore
+    trasparente in coda per i valori mancanti.
+    """
+    lut = np.zeros((n + 1, 4), dtype=np.uint8)
+    lut[:n] = np.round(plt.get_cmap(cmap_name, n)(np.arange(n)) * 255).astype(np.uint8)
+    lut[:n, 3] = 255
+    return lut
+
+
+def colorize_field(values, vmin, vmax, n=256):
+    """Indici nella LUT per ogni cella (n = valore mancante), come Normalize + cmap"""
+    scaled = (np.asarray(values, dtype=np.float64) - vmin) / (vmax - vmin)
+    idx = np.floor(scaled * n)
+    idx = np.clip(np.nan_to_num(idx, nan=n), 0, n)
+    idx[np.isnan(scaled)] = n
+    idx[(scaled >= 1.0) & ~np.isnan(scaled)] = n - 1
+    return idx.astype(np.uint16)
+
+
+def _nearest_index(coords, lo, hi, n_pixels):
+    """
+    Per ogni pixel (centro) tra lo e hi, l'indice della cella più vicina
+    in coords, -1 se il pixel cade fuori dalla griglia.
+    """
+    order = np.argsort(coords)
+    ordered = np.asarray(coords, dtype=np.float64)[order]
+    if ordered.size > 1:
+        mids = (ordered[1:] + ordered[:-1]) / 2
+        first = ordered[0] - (ordered[1] - ordered[0]) / 2
+        last = ordered[-1] + (ordered[-1] - ordered[-2]) / 2
+        edges = np.concatenate([[first], mids, [last]])
+    else:
+        edges = np.array([ordered[0] - 0.5, ordered[0] + 0.5])
+
+    pixels = lo + (np.arange(n_pixels) + 0.5) / n_pixels * (hi - lo)
+    pos = np.searchsorted(edges, pixels) - 1
+    valid = (pos >= 0) & (pos < ordered.size)
+    return np.where(valid, order[np.clip(pos, 0, ordered.size - 1)], -1)
+
+
+def _alpha_over(src, dst, index=None):
+    """
+    Compone src (RGBA non premoltiplicato) sopra dst (RGB/RGBA opaco), sul posto.
+    Lavora solo sui pixel non trasparenti di src (index, se già noti).
+    """
+    if index is None:
+        index = np.nonzero(src[:, :, 3])
+    rgb = dst[:, :, :3]
+    pixels = src[index]
+    alpha = pixels[:, 3:4].astype(np.uint16)
+    blended = pixels[:, :3].astype(np.uint16) * alpha + rgb[index].astype(np.uint16) * (255 - alpha)
+    rgb[index] = ((blended + 127) // 255).astype(np.uint8)
+    return dst
+
+
+def _render_static_layers(config, vmin, vmax, piemonte, figsize, xlim, ylim, dpi):
+    """
+    Rasterizza una volta il contenuto statico in due layer:
+    - sotto: sfondo, assi, etichette e colorbar (RGBA opaco)
+    - sopra: confini del Piemonte, griglia e bordo assi (trasparente altrove)
+    Restituisce anche l'aspect impostato da geopandas, da riusare nel layer dinamico,
+    e il box degli assi in pixel (riga0, riga1, col0, col1).
+    """
+    fig, ax, cbar = _build_figure(config, vmin, vmax, figsize, xlim, ylim, dpi)
+    try:
+        before = {id(artist) for artist in ax.get_children()}
+        piemonte.boundary.plot(ax=ax, color='red', linewidth=2)
+        boundary = [artist for artist in ax.get_children() if id(artist) not in before]
+        aspect = ax.get_aspect()
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+
+        for artist in boundary:
+            artist.set_visible(False)
+        under = _to_rgba(fig)
+
+        # Box degli assi in pixel (righe dall'alto) per il raster diretto dei dati
+        height = under.shape[0]
+        extent = ax.get_window_extent()
+        box = (height - int(round(extent.y1)), height - int(round(extent.y0)),
+               int(round(extent.x0)), int(round(extent.x1)))
+
+        for artist in boundary:
+            artist.set_visible(True)
+        ax.grid(True, alpha=0.3)
+
+        # Solo confini, griglia e bordo assi: nasconde tutto il resto
+        fig.patch.set_alpha(0)
+        ax.patch.set_alpha(0)
+        ax.tick_params(labelbottom=False, labelleft=False, length=0)
+        ax.xaxis.label.set_visible(False)
+        ax.yaxis.label.set_visible(False)
+        cbar.ax.set_visible(False)
+        over = _to_rgba(fig)
+    finally:
+        plt.close(fig)
+    return under, over, aspect, box
+
+
+class CompositeFrameRenderer:
+    """
+    Renderer che compone ogni frame da più layer:
+    statico sotto (cache) + dati + isolinee e titolo + statico sopra (cache).
+
+    Con fast_raster=True il campo viene colorato direttamente con una LUT
+    della colormap e ingrandito con indicizzazione NumPy: matplotlib disegna
+    solo isolinee e titolo. Con fast_raster=False i dati passano da pcolormesh.
+    """
+
+    def __init__(self, config, vmin, vmax, piemonte, figsize=(12, 10),
+                 xlim=(6.5, 9.3), ylim=(44.0, 46.6), dpi=100, fast_raster=True):
+        self.config = config
+        self.vmin = vmin
+        self.vmax = vmax
+        self.xlim = tuple(xlim)
+        self.ylim = tuple(ylim)
+        self.fast_raster = fast_raster
+
+        key = (config['cmap'], config['label'], float(vmin), float(vmax),
+               tuple(figsize), dpi, self.xlim, self.ylim,
+               len(piemonte), tuple(np.round(piemonte.total_bounds, 6)))
+        self.under, self.over, aspect, self.box = _static_layers(
+            key, lambda: _render_static_layers(config, vmin, vmax, piemonte,
+                                               figsize, self.xlim, self.ylim, dpi))
+        self._over_index = np.nonzero(self.over[:, :, 3])
+
+        self.lut = build_colormap_lut(config['cmap'])
+        self._lut32 = self.lut.view(np.uint32).ravel()
+        self._pixel_index = {}
+
+        # Figura per il layer dinamico: stesso layout, tutto trasparente
+        self.fig, self.ax, cbar = _build_figure(config, vmin, vmax, figsize,
+                                                self.xlim, self.ylim, dpi, aspect=aspect)
+        self.fig.patch.set_alpha(0)
+        self.ax.set_axis_off()
+        cbar.ax.set_visible(False)
+        self._artists = []
+
+    def rasterize(self, field):
+        """
+        Campo -> pixel RGBA (uint32 impacchettati) grandi quanto il box degli assi.
+        I pixel senza dato o fuori griglia valgono 0 (trasparenti).
+        """
+        r0, r1, c0, c1 = self.box
+        lon = field['longitude']
+        lat = field['latitude']
+
+        # Indici pixel -> cella, calcolati una volta per griglia
+        grid_key = (lon.size, float(lon[0]), float(lon[-1]), lat.size, float(lat[0]), float(lat[-1]))
+        if grid_key not in self._pixel_index:
+            cols = _nearest_index(lon, self.xlim[0], self.xlim[1], c1 - c0)
+            # Le righe dell'immagine vanno da nord a sud
+            rows = _nearest_index(lat, self.ylim[0], self.ylim[1], r1 - r0)[::-1]
+            # L'indice -1 (fuori griglia) cade sulla riga/colonna extra
+            rows = np.where(rows < 0, lat.size, rows)
+            cols = np.where(cols < 0, lon.size, cols)
+            self._pixel_index[grid_key] = rows[:, None] * (lon.size + 1) + cols[None, :]
+        flat_index = self._pixel_index[grid_key]
+
+        # Colori alla risoluzione della griglia, poi ingranditi per indicizzazione
+        n = self.lut.shape[0] - 1
+        idx = np.full((lat.size + 1, lon.size + 1), n, dtype=np.uint16)
+        idx[:-1, :-1] = colorize_field(field['values'], self.vmin, self.vmax, n)
+        return self._lut32[idx].ravel()[flat_index]
+
+    def render(self, field, title, contours=None, contour_fmt='%d'):
+        """Disegna un frame e restituisce l'immagine RGB composta"""
+        for artist in self._artists:
+            artist.remove()
+        before = {id(artist) for artist in self.ax.get_children()}
+
+        if not self.fast_raster:
+            self.ax.pcolormesh(field['longitude'], field['latitude'], field['values'],
+                               cmap=self.config['cmap'], vmin=self.vmin, vmax=self.vmax,
+                               shading='auto')
+        if contours is not None:
+            draw_contours(self.ax, contours, fmt=contour_fmt)
+        self.ax.set_xlim(self.xlim)
+        self.ax.set_ylim(self.ylim)
+        self.ax.set_title(title, fontsize=14, fontweight='bold')
+
+        self._artists = [artist for artist in self.ax.get_children() if id(artist) not in before]
+
+        frame = self.under.copy()
+        if self.fast_raster:
+            # La LUT è opaca: basta copiare i pixel con un valore valido
+            r0, r1, c0, c1 = self.box
+            raster = self.rasterize(field)
+            region = frame.view(np.uint32)[r0:r1, c0:c1, 0]
+            np.copyto(region, raster, where=raster != 0)
+
+        self.fig.canvas.draw()
+        _alpha_over(np.asarray(self.fig.canvas.buffer_rgba()), frame)
+        _alpha_over(self.over, frame, index=self._over_index)
+        return frame[:, :, :3]
+
+    def close(self):
+        plt.close(self.fig)
@@ -2,12 +2,11 @@ import requests
 from datetime import datetime, timedelta
 import os
 
-def download_gfs_for_target(target_time, run_time, variable='APCP', level='surface', output_dir='gfs_data'):
+def forecast_hour_for(target_time, run_time):
     """
-    Scarica dati GFS per una specifica run
+    Ora di previsione GFS disponibile per il target (passo 3h fino a 120h, poi 6h).
+    None se il target è fuori dall'orizzonte del run.
     """
-    os.makedirs(output_dir, exist_ok=True)
-    
     forecast_hours = int((target_time - run_time).total_seconds() / 3600)
     
     if forecast_hours < 0 or forecast_hours > 384:
@@ -18,14 +17,16 @@ def download_gfs_for_target(target_time, run_time, variable='APCP', level='surfa
     else:
         forecast_hours = (forecast_hours // 6) * 6
     
+    return forecast_hours
+
+def fetch_gfs_message(run_time, forecast_hours, variable, level):
+    """
+    Scarica dal filtro NOMADS i messaggi GRIB di una variabile.
+    Restituisce i byte o None.
+    """
     cycle = run_time.hour
     date_str = run_time.strftime("%Y%m%d")
     
-    output_file = os.path.join(output_dir, f'gfs_{variable}_{date_str}_{cycle:02d}z_f{forecast_hours:03d}.grib2')
-    
-    if os.path.exists(output_file):
-        return output_file
-    
     base_url = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
     
     params = {
@@ -41,15 +42,61 @@ def download_gfs_for_target(target_time, run_time, variable='APCP', level='surfa
     }
     
     try:
-        response = requests.get(base_url, params=params, stream=True, timeout=30)
+        response = requests.get(base_url, params=params, timeout=30)
         
-        if response.status_code == 200:
-            with open(output_file, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    f.write(chunk)
-            return output_file
+        if response.status_code == 200 and response.content.startswith(b'GRIB'):
+            return response.content
         else:
             return None
     except Exception as e:
         print(f"Errore download: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def download_gfs_for_target(target_time, run_time, variable='APCP', level='surface', output_dir='gfs_data'):
+    """
+    Scarica dati GFS per una specifica run
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    
+    forecast_hours = forecast_hour_for(target_time, run_time)
+    
+    if forecast_hours is None:
+        return None
+    
+    cycle = run_time.hour
+    date_str = run_time.strftime("%Y%m%d")
+    
+    output_file = os.path.join(output_dir, f'gfs_{variable}_{date_str}_{cycle:02d}z_f{forecast_hours:03d}.grib2')
+    
+    if os.path.exists(output_file):
+        return output_file
+    
+    data = fetch_gfs_message(run_time, forecast_hours, variable, level)
+    
+    if data is None:
+        return None
+    
+    with open(output_file, 'wb') as f:
+        f.write(data)
+    return output_file
+
+def download_gfs_to_archive(target_time, run_time, archive, variable='APCP', level='surface'):
+    """
+    Come download_gfs_for_target, ma accoda il GRIB all'archivio (GribArchive)
+    invece di creare un file per run. Restituisce l'ora di previsione o None.
+    """
+    forecast_hours = forecast_hour_for(target_time, run_time)
+    
+    if forecast_hours is None:
+        return None
+    
+    if archive.has(run_time, variable, level, forecast_hours):
+        return forecast_hours
+    
+    data = fetch_gfs_message(run_time, forecast_hours, variable, level)
+    
+    if data is None:
+        return None
+    
+    archive.append(run_time, variable, level, forecast_hours, data)
+    return forecast_hours
@@ -0,0 +1,157 @@
+import os
+import io
+import struct
+import numpy as np
+from PIL import Image
+
+
+class IncrementalGifWriter:
+    """
+    Scrive una GIF animata un frame alla volta.
+    Ogni frame viene codificato e scritto subito su disco, quindi la memoria
+    usata non dipende dal numero di frame.
+    """
+
+    def __init__(self, output_file, fps=1.5, loop=0):
+        self.output_file = output_file
+        self.tmp_file = output_file + '.tmp'
+        self.delay = int(round(100 / fps))  # centesimi di secondo
+        self.loop = loop
+        self.size = None
+        self.n_frames = 0
+        self._f = open(self.tmp_file, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def add_frame(self, frame):
+        """
+        Aggiunge un frame (array RGB/RGBA o immagine PIL).
+        Restituisce il blocco codificato, riutilizzabile con add_encoded_frame.
+        """
+        if isinstance(frame, np.ndarray):
+            frame = Image.fromarray(frame)
+        block = self.encode_frame(frame)
+        self.add_encoded_frame(block, frame.size)
+        return block
+
+    def add_encoded_frame(self, block, size):
+        """Aggiunge un frame già codificato da encode_frame"""
+        size = tuple(size)
+        if self.size is None:
+            self.size = size
+            self._write_header()
+        elif size != self.size:
+            raise ValueError(f"Dimensione frame {size} diversa da {self.size}")
+
+        self._f.write(block)
+        self.n_frames += 1
+
+    def encode_frame(self, frame):
+        """Codifica un frame nel blocco GIF (GCE + immagine + palette locale)"""
+        if isinstance(frame, np.ndarray):
+            frame = Image.fromarray(frame)
+        if frame.mode != 'RGB':
+            frame = frame.convert('RGB')
+
+        # Codifica il singolo frame con Pillow e ne estrae il blocco immagine
+        frame = frame.convert('P', palette=Image.Palette.ADAPTIVE, colors=256)
+        buf = io.BytesIO()
+        frame.save(buf, format='GIF')
+        return self._extract_image_block(buf.getvalue())
+
+    def close(self):
+        """Chiude la GIF e la sposta sul file finale"""
+        if self._f is None:
+            return
+        self._f.write(b'\x3b')
+        self._f.close()
+        self._f = None
+        os.replace(self.tmp_file, self.output_file)
+
+    def abort(self):
+        """Scarta la GIF parziale"""
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+    def _write_header(self):
+        width, height = self.size
+        # Logical Screen Descriptor senza palette globale: ogni frame ha la sua
+        self._f.write(b'GIF89a')
+        self._f.write(struct.pack('<HHBBB', width, height, 0x70, 0, 0))
+        # Estensione NETSCAPE per il loop
+        self._f.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01')
+        self._f.write(struct.pack('<H', self.loop))
+        self._f.write(b'\x00')
+
+    def _extract_image_block(self, data):
+        pos = 6
+        _, _, packed, _, _ = struct.unpack_from('<HHBBB', data, pos)
+        pos += 7
+
+        global_table = b''
+        global_bits = 0
+        if packed & 0x80:
+            global_bits = packed & 0x07
+            table_len = 3 * (2 ** (global_bits + 1))
+            global_table = data[pos:pos + table_len]
+            pos += table_len
+
+        while pos < len(data):
+            block = data[pos]
+            if block == 0x21:
+                # Estensione: salta label e sotto-blocchi
+                pos += 2
+                pos = self._skip_sub_blocks(data, pos)
+            elif block == 0x2c:
+                left, top, width, height, img_packed = struct.unpack_from('<HHHHB', data, pos + 1)
+                pos += 10
+
+                if img_packed & 0x80:
+                    local_bits = img_packed & 0x07
+                    table_len = 3 * (2 ** (local_bits + 1))
+                    color_table = data[pos:pos + table_len]
+                    pos += table_len
+                else:
+                    local_bits = global_bits
+                    color_table = global_table
+                    img_packed = (img_packed & 0x40) | 0x80 | local_bits
+
+                # Graphic Control Extension con la durata del frame
+                out = io.BytesIO()
+                out.write(b'\x21\xf9\x04\x04')
+                out.write(struct.pack('<H', self.delay))
+                out.write(b'\x00\x00')
+
+                out.write(b'\x2c')
+                out.write(struct.pack('<HHHHB', left, top, width, height, img_packed))
+                out.write(color_table)
+
+                # LZW minimum code size + dati compressi
+                end = self._skip_sub_blocks(data, pos + 1)
+                out.write(data[pos:end])
+                return out.getvalue()
+            else:
+                break
+
+        raise ValueError("Frame GIF non valido: blocco immagine non trovato")
+
+    @staticmethod
+    def _skip_sub_blocks(data, pos):
+        while True:
+            size = data[pos]
+            pos += 1
+            if size == 0:
+                return pos
+            pos += size
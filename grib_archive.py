@@ -0,0 +1,319 @@
+import os
+import re
+import sys
+import json
+import mmap
+import fcntl
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+# Nomi dei file GRIB singoli scritti da download_gfs_for_target
+_LEGACY_NAME = re.compile(r'^gfs_(?P<variable>[A-Z]+)_(?P<date>\d{8})_(?P<cycle>\d{2})z_f(?P<lead>\d{3})\.grib2$')
+# Quei nomi non contengono il livello: si deduce solo per le variabili usate a un livello
+# solo (TMP si scarica a 850 e 500 hPa, il livello va indicato con --level)
+_SINGLE_LEVEL = {'HGT': '500_mb', 'APCP': 'surface'}
+
+
+def _cycle_key(run_time):
+    return run_time.strftime('%Y%m%d_%Hz')
+
+
+def _entry_key(variable, level, lead):
+    return f"{variable}_{level}_f{lead:03d}"
+
+
+# Un'istanza per cartella, condivisa nel processo (mmap e indici in memoria)
+_OPEN_ARCHIVES = {}
+_OPEN_ARCHIVES_LOCK = threading.Lock()
+
+
+def open_archive(archive_dir='gfs_archive'):
+    """Restituisce l'archivio condiviso per la cartella indicata"""
+    key = os.path.abspath(archive_dir)
+    with _OPEN_ARCHIVES_LOCK:
+        if key not in _OPEN_ARCHIVES:
+            _OPEN_ARCHIVES[key] = GribArchive(archive_dir)
+        return _OPEN_ARCHIVES[key]
+
+
+class GribArchive:
+    """
+    Archivio locale dei GRIB scaricati: un file pack per ciclo GFS
+    (gfs_YYYYMMDD_HHz.pack) con i messaggi accodati e un indice JSON
+    (gfs_YYYYMMDD_HHz.index.json) chiave -> [offset, lunghezza].
+    Le letture sono range read su mmap, la retention cancella pack interi.
+    """
+
+    def __init__(self, archive_dir='gfs_archive'):
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._indexes = {}
+        # Inode del pack a cui si riferisce l'indice in memoria (compact lo sostituisce)
+        self._inodes = {}
+        self._maps = {}
+        self._scan()
+
+    # --- Percorsi e indici ---
+
+    def _pack_path(self, cycle):
+        return os.path.join(self.archive_dir, f"gfs_{cycle}.pack")
+
+    def _index_path(self, cycle):
+        return os.path.join(self.archive_dir, f"gfs_{cycle}.index.json")
+
+    def _scan(self):
+        """Carica tutti gli indici con un solo listdir"""
+        for name in os.listdir(self.archive_dir):
+            if name.startswith('gfs_') and name.endswith('.index.json'):
+                self._load_cycle(name[len('gfs_'):-len('.index.json')])
+
+    def _read_index(self, cycle):
+        try:
+            with open(self._index_path(cycle)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_cycle(self, cycle):
+        """
+        Rilegge l'indice del ciclo con il pack bloccato in lettura: append e
+        compact tengono il lock esclusivo finché pack e indice non sono
+        coerenti, quindi gli offset valgono per il pack di quell'inode.
+        """
+        try:
+            with open(self._pack_path(cycle), 'rb') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                try:
+                    index = self._read_index(cycle)
+                    inode = os.fstat(f.fileno()).st_ino
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except FileNotFoundError:
+            index, inode = self._read_index(cycle), None
+        self._indexes[cycle] = index
+        self._inodes[cycle] = inode
+        return index
+
+    def _pack_inode(self, cycle):
+        try:
+            return os.stat(self._pack_path(cycle)).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _write_index(self, cycle, index):
+        path = self._index_path(cycle)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, path)
+
+    def _close_map(self, cycle):
+        mm = self._maps.pop(cycle, None)
+        if mm is not None:
+            mm.close()
+
+    # --- Lettura e scrittura ---
+
+    def _entry(self, run_time, variable, level, lead):
+        cycle = _cycle_key(run_time)
+        key = _entry_key(variable, level, lead)
+        entry = self._indexes.get(cycle, {}).get(key)
+        if entry is None and os.path.exists(self._index_path(cycle)):
+            # Può averlo scritto un altro processo: rilegge l'indice del ciclo
+            entry = self._load_cycle(cycle).get(key)
+        return cycle, entry
+
+    def has(self, run_time, variable, level, lead):
+        return self._entry(run_time, variable, level, lead)[1] is not None
+
+    def append(self, run_time, variable, level, lead, data):
+        """Accoda un messaggio GRIB al pack del ciclo e aggiorna l'indice"""
+        cycle = _cycle_key(run_time)
+        pack = self._pack_path(cycle)
+        with self._lock:
+            while True:
+                with open(pack, 'ab') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        # Se compact ha sostituito il pack nel frattempo, si riapre
+                        if os.fstat(f.fileno()).st_ino != os.stat(pack).st_ino:
+                            continue
+                        # Un altro processo può aver aggiornato l'indice nel frattempo
+                        index = self._read_index(cycle)
+                        offset = f.seek(0, os.SEEK_END)
+                        f.write(data)
+                        f.flush()
+                        index[_entry_key(variable, level, lead)] = [offset, len(data)]
+                        self._write_index(cycle, index)
+                        self._indexes[cycle] = index
+                        self._inodes[cycle] = os.fstat(f.fileno()).st_ino
+                        return
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self, run_time, variable, level, lead):
+        """Restituisce i byte del messaggio (range read su mmap) o None"""
+        cycle, entry = self._entry(run_time, variable, level, lead)
+        if entry is None:
+            return None
+        key = _entry_key(variable, level, lead)
+
+        with self._lock:
+            while True:
+                if self._pack_inode(cycle) != self._inodes.get(cycle):
+                    # Pack sostituito (compact, anche di un altro processo):
+                    # offset in memoria e mappatura si riferiscono al file vecchio
+                    self._close_map(cycle)
+                    entry = self._load_cycle(cycle).get(key)
+                    if entry is None:
+                        return None
+                offset, length = entry
+                mm = self._maps.get(cycle)
+                if mm is None or offset + length > len(mm):
+                    # Pack cresciuto dopo l'ultima mappatura: rimappa
+                    self._close_map(cycle)
+                    with open(self._pack_path(cycle), 'rb') as f:
+                        if os.fstat(f.fileno()).st_ino != self._inodes.get(cycle):
+                            continue
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[cycle] = mm
+                return mm[offset:offset + length]
+
+    def cycles(self):
+        """Run presenti in archivio, in ordine cronologico"""
+        return sorted(datetime.strptime(cycle, '%Y%m%d_%Hz') for cycle in self._indexes)
+
+    # --- Manutenzione ---
+
+    def import_directory(self, src_dir='gfs_data', remove=False, levels=None):
+        """
+        Importa i vecchi file gfs_<VAR>_<data>_<ciclo>z_f<lead>.grib2.
+        levels ({variabile: livello}) indica il livello delle variabili che
+        ne hanno più d'uno: senza, i loro file si saltano.
+        """
+        levels = dict(_SINGLE_LEVEL, **(levels or {}))
+        imported = 0
+        skipped = set()
+        for name in sorted(os.listdir(src_dir)):
+            match = _LEGACY_NAME.match(name)
+            if not match:
+                continue
+            variable = match['variable']
+            level = levels.get(variable)
+            if level is None:
+                skipped.add(variable)
+                continue
+            run_time = datetime.strptime(match['date'] + match['cycle'], '%Y%m%d%H')
+            lead = int(match['lead'])
+            path = os.path.join(src_dir, name)
+
+            if not self.has(run_time, variable, level, lead):
+                with open(path, 'rb') as f:
+                    self.append(run_time, variable, level, lead, f.read())
+                imported += 1
+            if remove:
+                os.remove(path)
+        for variable in sorted(skipped):
+            print(f"⚠️ {variable}: livello ignoto, file saltati (usa --level {variable}=<livello>)")
+        return imported
+
+    def compact(self, max_age_days=None, now=None):
+        """
+        Elimina i cicli più vecchi di max_age_days e riscrive i pack che
+        contengono byte non più indicizzati (messaggi sovrascritti).
+        Restituisce i byte liberati.
+        """
+        now = now or datetime.utcnow()
+        freed = 0
+        with self._lock:
+            for cycle in list(self._indexes):
+                pack = self._pack_path(cycle)
+                run_time = datetime.strptime(cycle, '%Y%m%d_%Hz')
+                size = os.path.getsize(pack) if os.path.exists(pack) else 0
+
+                if max_age_days is not None and now - run_time > timedelta(days=max_age_days):
+                    freed += self._remove_cycle(cycle)
+                    continue
+
+                index = self._indexes[cycle]
+                live = sum(length for _, length in index.values())
+                if live >= size:
+                    continue
+
+                # Riscrive solo i messaggi ancora indicizzati
+                self._close_map(cycle)
+                tmp = f"{pack}.{os.getpid()}.tmp"
+                new_index = {}
+                with open(pack, 'rb') as src, open(tmp, 'wb') as dst:
+                    fcntl.flock(src, fcntl.LOCK_EX)
+                    # Chi apre il nuovo pack aspetta che anche l'indice sia riscritto
+                    fcntl.flock(dst, fcntl.LOCK_EX)
+                    try:
+                        index = self._read_index(cycle)
+                        size = os.fstat(src.fileno()).st_size
+                        live = sum(length for _, length in index.values())
+                        for key, (offset, length) in sorted(index.items(), key=lambda item: item[1][0]):
+                            src.seek(offset)
+                            new_index[key] = [dst.tell(), length]
+                            dst.write(src.read(length))
+                        dst.flush()
+                        os.replace(tmp, pack)
+                        self._write_index(cycle, new_index)
+                        self._inodes[cycle] = os.fstat(dst.fileno()).st_ino
+                    finally:
+                        fcntl.flock(dst, fcntl.LOCK_UN)
+                        fcntl.flock(src, fcntl.LOCK_UN)
+                self._indexes[cycle] = new_index
+                freed += size - live
+        return freed
+
+    def cycle_files(self, run_time):
+        """File su disco (pack, indice) di un ciclo"""
+        cycle = _cycle_key(run_time)
+        return [self._pack_path(cycle), self._index_path(cycle)]
+
+    def remove_cycle(self, run_time):
+        """Elimina un ciclo dall'archivio, restituisce i byte liberati"""
+        with self._lock:
+            return self._remove_cycle(_cycle_key(run_time))
+
+    def _remove_cycle(self, cycle):
+        self._close_map(cycle)
+        freed = 0
+        for path in (self._pack_path(cycle), self._index_path(cycle)):
+            if os.path.exists(path):
+                freed += os.path.getsize(path)
+                os.remove(path)
+        self._indexes.pop(cycle, None)
+        self._inodes.pop(cycle, None)
+        return freed
+
+    def close(self):
+        with self._lock:
+            for cycle in list(self._maps):
+                self._close_map(cycle)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Gestione archivio GRIB locale")
+    parser.add_argument('--archive-dir', default='gfs_archive')
+    sub = parser.add_subparsers(dest='command', required=True)
+    imp = sub.add_parser('import', help="importa i file .grib2 di una cartella")
+    imp.add_argument('src_dir', nargs='?', default='gfs_data')
+    imp.add_argument('--remove', action='store_true', help="cancella i file importati")
+    imp.add_argument('--level', action='append', default=[], metavar='VAR=LIVELLO',
+                     help="livello dei file di una variabile, es. TMP=850_mb")
+    comp = sub.add_parser('compact', help="applica la retention e compatta i pack")
+    comp.add_argument('--max-age-days', type=float, default=7)
+    args = parser.parse_args()
+
+    archive = GribArchive(args.archive_dir)
+    if args.command == 'import':
+        levels = dict(item.split('=', 1) for item in args.level)
+        imported = archive.import_directory(args.src_dir, remove=args.remove, levels=levels)
+        print(f"✓ Importati {imported} file")
+    else:
+        print(f"✓ Liberati {archive.compact(max_age_days=args.max_age_days) / 1024:.1f} KB")
+    sys.stdout.flush()
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import argparse
+import threading
+import tracemalloc
+import uuid
+from collections import Counter
+from datetime import datetime
+
+# Sessione attiva per thread: ogni richiesta Streamlit gira nel suo thread
+_ACTIVE = threading.local()
+
+# tracemalloc è unico per processo: resta attivo finché una sessione lo usa
+_MEMORY_LOCK = threading.Lock()
+_MEMORY = {'sessions': 0, 'started': False}
+
+# Foglie di stack dei thread in attesa (server, pool inattivi): escluse dai campioni
+_IDLE_LEAVES = {
+    ('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'),
+    ('thread.py', '_worker'), ('socketserver.py', 'serve_forever'),
+}
+
+
+def mark_stage(name):
+    """
+    Segna l'inizio di una fase della pipeline (chiude la precedente).
+    Senza una ProfileSession attiva nel thread non fa nulla.
+    """
+    session = getattr(_ACTIVE, 'session', None)
+    if session is not None:
+        session.mark(name)
+
+
+def _start_memory():
+    with _MEMORY_LOCK:
+        if _MEMORY['sessions'] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            _MEMORY['started'] = True
+        _MEMORY['sessions'] += 1
+
+
+def _stop_memory():
+    with _MEMORY_LOCK:
+        _MEMORY['sessions'] -= 1
+        if _MEMORY['sessions'] == 0 and _MEMORY['started']:
+            tracemalloc.stop()
+            _MEMORY['started'] = False
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Profiler a campionamento: ogni interval secondi legge lo stack di tutti
+    i thread (anche i worker dask, che cProfile non vede) e conta gli stack
+    nel formato "folded" di flamegraph.pl / speedscope.
+    """
+
+    def __init__(self, main_thread_id, interval=0.005):
+        self.main_thread_id = main_thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                if thread_id != self.main_thread_id and leaf in _IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(f"thread:{names.get(thread_id, thread_id)}")
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    """
+    Profilazione di una generazione, attivabile per singola richiesta:
+    - cProfile sul thread della pipeline -> pipeline.prof (pstats, snakeviz)
+    - opzionale campionamento di tutti i thread -> stacks.folded (flamegraph)
+    - opzionale tracemalloc: snapshot a fine fase -> <n>_<fase>.tracemalloc
+    - tempi e memoria per fase -> stages.json
+    Le fasi si segnano con mark_stage() dentro la pipeline. Con più sessioni
+    contemporanee tracemalloc è condiviso: memoria e picco sono del processo.
+    """
+
+    def __init__(self, output_dir='profiles', label='pipeline', memory=False, sampling=False):
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        # Suffisso casuale: sessioni avviate nello stesso secondo non si sovrascrivono
+        self.output_dir = os.path.join(output_dir, f"{stamp}_{label}_{uuid.uuid4().hex[:6]}")
+        self.memory = memory
+        self.sampling = sampling
+        self.stages = []
+        self.profile = cProfile.Profile()
+        self._sampler = None
+        self._current = None
+        self._profiling = False
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.memory:
+            _start_memory()
+        if self.sampling:
+            self._sampler = StackSampler(threading.get_ident())
+            self._sampler.start()
+        _ACTIVE.session = self
+        self._start = time.perf_counter()
+        self.mark('avvio')
+        self.profile.enable()
+        self._profiling = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profile.disable()
+        self._profiling = False
+        self._close_stage()
+        # La cartella può essere stata eliminata dal budget della cache durante una generazione lunga
+        os.makedirs(self.output_dir, exist_ok=True)
+        _ACTIVE.session = None
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler.write_folded(os.path.join(self.output_dir, 'stacks.folded'))
+        if self.memory:
+            _stop_memory()
+        self.profile.dump_stats(os.path.join(self.output_dir, 'pipeline.prof'))
+        with open(os.path.join(self.output_dir, 'stages.json'), 'w') as f:
+            json.dump({'total_s': time.perf_counter() - self._start, 'stages': self.stages,
+                       'hot_spots': self.hot_spots()}, f, indent=2)
+        print(f"🔬 Profilo salvato in {self.output_dir}")
+        sys.stdout.flush()
+        return False
+
+    def mark(self, name):
+        # Gli snapshot di tracemalloc non devono finire nel profilo né nei tempi
+        if self._profiling:
+            self.profile.disable()
+        self._close_stage()
+        if self._profiling:
+            self.profile.enable()
+        self._current = {'stage': name, 'start': time.perf_counter()}
+
+    def _close_stage(self):
+        if self._current is None:
+            return
+        stage = self._current
+        self._current = None
+        record = {'stage': stage['stage'], 'seconds': round(time.perf_counter() - stage['start'], 4)}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            record['memory_mb'] = round(current / 1024 ** 2, 2)
+            record['peak_mb'] = round(peak / 1024 ** 2, 2)
+            snapshot = tracemalloc.take_snapshot()
+            name = f"{len(self.stages):02d}_{stage['stage']}.tracemalloc"
+            os.makedirs(self.output_dir, exist_ok=True)
+            snapshot.dump(os.path.join(self.output_dir, name))
+            record['snapshot'] = name
+            record['top_allocations'] = [
+                {'where': str(stat.traceback[0]), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:5]
+            ]
+            tracemalloc.reset_peak()
+        self.stages.append(record)
+
+    def hot_spots(self, n=20, sort='tottime'):
+        """Funzioni più costose: [{'function', 'calls', 'tottime', 'cumtime'}, ...]"""
+        stats = pstats.Stats(self.profile)
+        rows = []
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                'function': f"{name} ({os.path.basename(filename)}:{line})",
+                'calls': calls,
+                'tottime': round(tottime, 4),
+                'cumtime': round(cumtime, 4),
+            })
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows[:n]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Genera un'animazione con la profilazione attiva")
+    parser.add_argument('target', help="istante target, es. 2025-10-23T06")
+    parser.add_argument('--variable', default='HGT')
+    parser.add_argument('--level', default='500_mb')
+    parser.add_argument('--days-back', type=int, default=5)
+    parser.add_argument('--output', default='current_forecast.gif')
+    parser.add_argument('--profile-dir', default='profiles')
+    parser.add_argument('--memory', action='store_true', help="snapshot tracemalloc per fase")
+    parser.add_argument('--sampling', action='store_true', help="stack campionati per flamegraph")
+    parser.add_argument('--sort', choices=['tottime', 'cumtime'], default='tottime')
+    args = parser.parse_args()
+
+    from animation_creator import create_forecast_evolution_stream
+
+    target = datetime.fromisoformat(args.target)
+    with ProfileSession(args.profile_dir, label=args.variable, memory=args.memory,
+                        sampling=args.sampling) as session:
+        create_forecast_evolution_stream(target, days_back=args.days_back, variable=args.variable,
+                                         level=args.level, output_file=args.output)
+
+    print("\n⏱️ Fasi:")
+    for stage in session.stages:
+        memory = f", {stage['peak_mb']} MB picco" if 'peak_mb' in stage else ""
+        print(f"  {stage['stage']:<12} {stage['seconds']:8.3f} s{memory}")
+    print(f"\n🔥 Hot spot ({args.sort}):")
+    for row in session.hot_spots(15, sort=args.sort):
+        print(f"  {row['tottime']:8.3f} {row['cumtime']:8.3f} {row['calls']:>8}  {row['function']}")
+    sys.stdout.flush()
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import fcntl
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+
+CYCLE = np.timedelta64(6, 'h')
+MAX_LEAD = 384  # 16 giorni max GFS
+# Un ciclo GFS compare su NOMADS circa 3.5 ore dopo l'ora nominale
+PUBLISH_DELAY = np.timedelta64(210, 'm')
+# NOMADS tiene circa 10 giorni di cicli: quelli più vecchi si trovano solo in archivio
+RETENTION = np.timedelta64(10, 'D')
+
+INVENTORY_URL = ("https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/"
+                 "gfs.{date}/{cycle:02d}/atmos/gfs.t{cycle:02d}z.pgrb2.0p25.f{lead:03d}.idx")
+
+
+def plan_run_times(target_time, days_back, now=None):
+    """
+    Cicli (datetime64, in ordine cronologico) degli ultimi days_back giorni
+    che possono prevedere il target, con l'ora di previsione GFS per ciascuno
+    (passo 3h fino a 120h, poi 6h), calcolati in blocco con NumPy.
+    """
+    now = np.datetime64(now if now is not None else datetime.utcnow(), 'h')
+    latest = now - (now - np.datetime64('1970-01-01T00', 'h')) % CYCLE
+    cycles = latest - np.arange(days_back * 4)[::-1] * CYCLE
+    hours = (np.datetime64(target_time, 'h') - cycles).astype(np.int64)
+    valid = (hours >= 0) & (hours <= MAX_LEAD)
+    leads = np.where(hours <= 120, hours // 3 * 3, hours // 6 * 6)
+    return cycles[valid], leads[valid]
+
+
+def check_published(run_time, lead, timeout=5):
+    """HEAD sull'inventario .idx del file GFS: True/False, None se NOMADS non risponde"""
+    url = INVENTORY_URL.format(date=run_time.strftime('%Y%m%d'), cycle=run_time.hour, lead=lead)
+    try:
+        response = requests.head(url, timeout=timeout)
+    except requests.RequestException:
+        return None
+    if response.status_code == 200:
+        return True
+    if response.status_code == 404:
+        return False
+    return None
+
+
+class AvailabilityIndex:
+    """
+    Indice locale dei file GFS pubblicati: per ciclo, le ore di previsione
+    viste disponibili (definitivo) e quelle mancanti con l'istante del
+    controllo (si ricontrollano dopo missing_ttl secondi).
+    """
+
+    def __init__(self, path, missing_ttl=600):
+        self.path = path
+        self.missing_ttl = missing_ttl
+        self.data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def status(self, run_time, lead):
+        """True se pubblicato, False se mancante di recente, None se da controllare"""
+        entry = self.data.get(run_time.strftime('%Y%m%d%H'), {})
+        if lead in entry.get('available', []):
+            return True
+        checked = entry.get('missing', {}).get(str(lead))
+        if checked is not None and time.time() - checked < self.missing_ttl:
+            return False
+        return None
+
+    def mark(self, run_time, lead, available):
+        entry = self.data.setdefault(run_time.strftime('%Y%m%d%H'), {})
+        if available:
+            entry['available'] = sorted(set(entry.get('available', [])) | {int(lead)})
+            entry.get('missing', {}).pop(str(lead), None)
+        else:
+            entry.setdefault('missing', {})[str(lead)] = time.time()
+
+    def save(self, max_age_days=16):
+        """Salva unendo gli aggiornamenti di altri processi e scarta i cicli vecchi"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                merged = self._load()
+                for cycle, entry in self.data.items():
+                    current = merged.setdefault(cycle, {})
+                    current['available'] = sorted(set(current.get('available', [])) |
+                                                  set(entry.get('available', [])))
+                    missing = current.setdefault('missing', {})
+                    missing.update(entry.get('missing', {}))
+                    for lead in current['available']:
+                        missing.pop(str(lead), None)
+                oldest = (datetime.utcnow() - pd.Timedelta(days=max_age_days)).strftime('%Y%m%d%H')
+                self.data = {cycle: entry for cycle, entry in merged.items() if cycle >= oldest}
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w') as f:
+                    json.dump(self.data, f)
+                os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def plan_fetch(target_time, days_back, variable, level, archive=None, store=None,
+               index=None, now=None, check=check_published, workers=8):
+    """
+    Piano dei run per un target, in una chiamata. Per ogni ciclo candidato:
+    - 'warm': campo già in cache o GRIB già in archivio, niente rete
+    - 'available': pubblicato su NOMADS (indice o HEAD), da scaricare
+    - 'unknown': NOMADS non ha risposto al controllo, si prova a scaricare
+    - 'missing' / 'pending' / 'expired': si salta senza aspettare timeout
+    I controlli HEAD mancanti partono in parallelo e aggiornano l'indice.
+    """
+    now = np.datetime64(now if now is not None else datetime.utcnow(), 'm')
+    cycles, leads = plan_run_times(target_time, days_back, now=now)
+
+    # Età dei cicli in blocco: troppo recenti per NOMADS o già rimossi
+    age = now - cycles.astype('datetime64[m]')
+    pending = age < PUBLISH_DELAY
+    expired = age > RETENTION
+
+    plan = []
+    to_check = []
+    for run_time, lead, is_pending, is_expired in zip(pd.to_datetime(cycles).to_pydatetime(),
+                                                      leads.tolist(), pending, expired):
+        warm = bool((store is not None and store.has_field(run_time)) or
+                    (archive is not None and archive.has(run_time, variable, level, lead)))
+        known = index.status(run_time, lead) if index is not None else None
+        if warm:
+            status = 'warm'
+        elif known is not None:
+            status = 'available' if known else 'missing'
+        elif is_pending:
+            status = 'pending'
+        elif is_expired:
+            status = 'expired'
+        else:
+            status = 'unknown'
+            to_check.append(len(plan))
+        plan.append({'run_time': run_time, 'lead': lead, 'status': status, 'warm': warm})
+
+    if to_check and check is not None:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda i: check(plan[i]['run_time'], plan[i]['lead']), to_check))
+        for i, published in zip(to_check, results):
+            if published is None:
+                continue
+            plan[i]['status'] = 'available' if published else 'missing'
+            if index is not None:
+                index.mark(plan[i]['run_time'], plan[i]['lead'], published)
+        if index is not None:
+            index.save()
+
+    return plan
+
+
+def fetch_set(plan):
+    """Run da usare: già in locale, pubblicati o non verificabili"""
+    return [entry for entry in plan if entry['status'] in ('warm', 'available', 'unknown')]
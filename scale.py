@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import fcntl
+import argparse
+import numpy as np
+
+# Intervallo e risoluzione degli istogrammi per variabile (unità del campo decodificato)
+SKETCH_RANGES = {
+    'HGT': (4500.0, 6300.0),
+    'TMP': (-60.0, 50.0),
+    'APCP': (0.0, 300.0),
+}
+SKETCH_BINS = 1024
+
+SEASONS = {12: 'DJF', 1: 'DJF', 2: 'DJF', 3: 'MAM', 4: 'MAM', 5: 'MAM',
+           6: 'JJA', 7: 'JJA', 8: 'JJA', 9: 'SON', 10: 'SON', 11: 'SON'}
+
+
+def histogram_counts(values, lo, hi, bins):
+    """Conteggi per bin dei valori finiti; quelli fuori intervallo finiscono nei bin estremi"""
+    values = np.asarray(values, dtype=np.float64).ravel()
+    values = values[np.isfinite(values)]
+    idx = np.clip(((values - lo) / (hi - lo) * bins).astype(np.int64), 0, bins - 1)
+    return np.bincount(idx, minlength=bins).astype(np.int64)
+
+
+class QuantileSketch:
+    """
+    Sketch dei quantili a bin fissi: si aggiorna un run alla volta, si
+    unisce ad altri sketch (stesso intervallo) sommando i conteggi e dà
+    percentili con errore massimo di un bin, senza tenere i campi in memoria.
+    """
+
+    def __init__(self, lo, hi, bins=SKETCH_BINS, counts=None):
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.bins = int(bins)
+        self.counts = np.zeros(self.bins, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    @classmethod
+    def for_variable(cls, variable):
+        lo, hi = SKETCH_RANGES.get(variable, SKETCH_RANGES['HGT'])
+        return cls(lo, hi)
+
+    def empty(self):
+        return QuantileSketch(self.lo, self.hi, self.bins)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def update(self, values):
+        self.add_counts(histogram_counts(values, self.lo, self.hi, self.bins))
+        return self
+
+    def add_counts(self, counts):
+        self.counts += np.asarray(counts, dtype=np.int64)
+        return self
+
+    def merge(self, other):
+        if (other.lo, other.hi, other.bins) != (self.lo, self.hi, self.bins):
+            raise ValueError("Sketch con intervalli diversi non si possono unire")
+        return self.add_counts(other.counts)
+
+    def quantile(self, q):
+        """Quantile q (0-1), interpolato linearmente dentro il bin"""
+        total = self.count
+        if total == 0:
+            return np.nan
+        cumulative = np.cumsum(self.counts)
+        rank = q * total
+        i = int(np.searchsorted(cumulative, rank, side='left'))
+        i = min(i, self.bins - 1)
+        before = cumulative[i - 1] if i > 0 else 0
+        inside = (rank - before) / self.counts[i] if self.counts[i] else 0.0
+        width = (self.hi - self.lo) / self.bins
+        return self.lo + (i + min(max(inside, 0.0), 1.0)) * width
+
+    def to_dict(self):
+        nonzero = np.flatnonzero(self.counts)
+        return {'lo': self.lo, 'hi': self.hi, 'bins': self.bins,
+                'index': nonzero.tolist(), 'counts': self.counts[nonzero].tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['lo'], data['hi'], data['bins'])
+        sketch.counts[np.asarray(data['index'], dtype=np.int64)] = data['counts']
+        return sketch
+
+
+def season_of(when):
+    return SEASONS[when.month]
+
+
+class ScaleClimatology:
+    """
+    Istogrammi stagionali per (variabile, livello, stagione) in un file JSON
+    accanto alla cache, alimentati dagli sketch dei run già decodificati.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(variable, level, when):
+        return f"{variable}_{level}_{season_of(when)}"
+
+    def sketch(self, variable, level, when):
+        data = self.data.get(self.key(variable, level, when))
+        return QuantileSketch.from_dict(data) if data else None
+
+    def add(self, variable, level, when, sketches):
+        """Unisce gli sketch nuovi alla climatologia e salva (sicuro tra processi)"""
+        sketches = [sketch for sketch in sketches if sketch.count]
+        if not sketches:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Un altro processo può averla aggiornata nel frattempo
+                self.data = self._load()
+                key = self.key(variable, level, when)
+                total = QuantileSketch.from_dict(self.data[key]) if key in self.data else sketches[0].empty()
+                for sketch in sketches:
+                    total.merge(sketch)
+                self.data[key] = total.to_dict()
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w') as f:
+                    json.dump(self.data, f)
+                os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def adaptive_range(config, sketch, climatology=None):
+    """
+    Range robusto dai percentili dei run correnti (scale_quantiles, default 2-98%),
+    allargato al range climatologico della stagione se disponibile.
+    Restituisce (data_min, data_max) oppure None se non ci sono dati.
+    """
+    q_lo, q_hi = config.get('scale_quantiles', (0.02, 0.98))
+    if sketch is None or sketch.count == 0:
+        return None
+    data_min = sketch.quantile(q_lo)
+    data_max = sketch.quantile(q_hi)
+    if climatology is not None and climatology.count:
+        data_min = min(data_min, climatology.quantile(q_lo))
+        data_max = max(data_max, climatology.quantile(q_hi))
+    return data_min, data_max
+
+
+def build_climatology(cache_dir='cache'):
+    """Ricostruisce la climatologia dagli sketch salvati nelle cartelle di ForecastStore"""
+    from datetime import datetime
+    from forecast_store import ForecastStore
+
+    climatology = ScaleClimatology(os.path.join(cache_dir, 'climatology.json'))
+    climatology.data = {}
+    groups = {}
+    for name in sorted(os.listdir(cache_dir)):
+        parts = name.rsplit('_', 1)
+        if len(parts) != 2 or not parts[1].isdigit() or len(parts[1]) != 10:
+            continue
+        variable, level = parts[0].split('_', 1)
+        target_time = datetime.strptime(parts[1], '%Y%m%d%H')
+        store = ForecastStore(target_time, variable, level, cache_dir=cache_dir)
+        key = ScaleClimatology.key(variable, level, target_time)
+        groups.setdefault(key, (variable, level, target_time, []))[3].extend(store.load_sketches().values())
+
+    if os.path.exists(climatology.path):
+        os.remove(climatology.path)
+    for variable, level, when, sketches in groups.values():
+        climatology.add(variable, level, when, sketches)
+    return climatology
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Climatologia stagionale per le scale dei colori")
+    parser.add_argument('--cache-dir', default='cache')
+    args = parser.parse_args()
+
+    climatology = build_climatology(args.cache_dir)
+    for key, data in sorted(climatology.data.items()):
+        sketch = QuantileSketch.from_dict(data)
+        print(f"✓ {key}: {sketch.count} valori, 2-98% = "
+              f"{sketch.quantile(0.02):.1f} … {sketch.quantile(0.98):.1f}")
+    sys.stdout.flush()
@@ -0,0 +1,144 @@
+import os
+import fcntl
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+# Cartella condivisa tra processi/repliche (es. volume montato da tutti i worker)
+SHARED_DIR_ENV = 'METEO_SHARED_CACHE_DIR'
+BACKEND_ENV = 'METEO_CACHE_BACKEND'
+
+
+class CacheBackend(ABC):
+    """
+    Interfaccia di uno store chiave -> byte condiviso tra processi.
+    Le chiavi sono percorsi relativi con '/' (es. 'HGT_500_mb_2025102306/meta.json').
+    Un backend esterno (object store, Redis, ...) implementa get/put/exists/delete
+    e un lock esclusivo per chiave valido tra repliche; local_path restituisce
+    None se i dati non stanno su un filesystem locale.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """Byte salvati per la chiave, None se non c'è"""
+
+    @abstractmethod
+    def put(self, key, data):
+        """Scrittura atomica: chi legge vede il valore vecchio o quello nuovo"""
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def lock(self, key):
+        """Context manager: lock esclusivo sulla chiave tra processi e repliche"""
+
+    def local_path(self, key):
+        return None
+
+
+class LocalDiskBackend(CacheBackend):
+    """
+    Backend su disco locale o condiviso (NFS, volume): scritture atomiche
+    (file temporaneo + rename) e lock con flock su un file <chiave>.lock.
+    """
+
+    def __init__(self, root='cache'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, *key.split('/')))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Chiave fuori dalla cache: {key}")
+        return path
+
+    def local_path(self, key):
+        return self._path(key) if key else self.root
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def lock(self, key):
+        """Lock esclusivo tra processi e thread (ogni open ha il suo flock)"""
+        path = f"{self._path(key)}.lock"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def single_flight(backend, key, load, compute):
+    """
+    Restituisce (valore, calcolato). Se load() non trova il valore, un solo
+    processo alla volta esegue compute() (che deve anche salvarlo): gli altri
+    aspettano il lock e poi lo trovano già pronto.
+    """
+    value = load()
+    if value is not None:
+        return value, False
+    with backend.lock(key):
+        value = load()
+        if value is not None:
+            return value, False
+        return compute(), True
+
+
+# Backend disponibili, selezionabili con METEO_CACHE_BACKEND
+BACKENDS = {'local': LocalDiskBackend}
+
+_BACKENDS = {}
+_BACKENDS_LOCK = threading.Lock()
+
+
+def register_backend(name, factory):
+    """
+    Registra un backend esterno: factory(root) -> CacheBackend. Se factory è
+    una classe, deve implementare tutta l'interfaccia (TypeError subito).
+    """
+    if isinstance(factory, type):
+        if not issubclass(factory, CacheBackend):
+            raise TypeError(f"{factory.__name__} non è un CacheBackend")
+        missing = sorted(factory.__abstractmethods__)
+        if missing:
+            raise TypeError(f"{factory.__name__} non implementa: {', '.join(missing)}")
+    BACKENDS[name] = factory
+
+
+def get_backend(root=None):
+    """Backend condiviso del processo per la radice indicata (default da METEO_SHARED_CACHE_DIR)"""
+    root = root or os.environ.get(SHARED_DIR_ENV, 'cache')
+    name = os.environ.get(BACKEND_ENV, 'local')
+    with _BACKENDS_LOCK:
+        if (name, root) not in _BACKENDS:
+            _BACKENDS[(name, root)] = BACKENDS[name](root)
+        return _BACKENDS[(name, root)]
@@ -0,0 +1,124 @@
+import threading
+import http.client
+from http.server import ThreadingHTTPServer
+import pytest
+
+from artifact_server import ArtifactHandler, ArtifactStore
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Server artefatti su una porta libera, con un artefatto da 1024 byte"""
+    store = ArtifactStore(str(tmp_path))
+    name = store.put_bytes(DATA, 'gif')
+    handler = type('Handler', (ArtifactHandler,), {'store': store})
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd.server_address[1], name
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+
+def _get(server, headers=None, method='GET'):
+    port, name = server
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request(method, f"/artifacts/{name}", headers=headers or {})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def _etag(server):
+    return _get(server, method='HEAD')[1]['ETag']
+
+
+def test_full_response(server):
+    status, headers, body = _get(server)
+    assert status == 200
+    assert body == DATA
+    assert headers['Content-Type'] == 'image/gif'
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert 'immutable' in headers['Cache-Control']
+
+
+def test_unknown_artifact(server):
+    port, _ = server
+    status = _get((port, f"{'0' * 32}.gif"))[0]
+    assert status == 404
+
+
+def test_closed_range(server):
+    status, headers, body = _get(server, {'Range': 'bytes=10-19'})
+    assert status == 206
+    assert body == DATA[10:20]
+    assert headers['Content-Range'] == f"bytes 10-19/{len(DATA)}"
+
+
+def test_suffix_range(server):
+    status, headers, body = _get(server, {'Range': 'bytes=-100'})
+    assert status == 206
+    assert body == DATA[-100:]
+    assert headers['Content-Range'] == f"bytes {len(DATA) - 100}-{len(DATA) - 1}/{len(DATA)}"
+
+
+def test_open_range(server):
+    status, headers, body = _get(server, {'Range': 'bytes=1000-'})
+    assert status == 206
+    assert body == DATA[1000:]
+    assert headers['Content-Range'] == f"bytes 1000-{len(DATA) - 1}/{len(DATA)}"
+
+
+def test_range_end_clamped(server):
+    status, headers, body = _get(server, {'Range': 'bytes=1000-5000'})
+    assert status == 206
+    assert body == DATA[1000:]
+
+
+@pytest.mark.parametrize('range_header', ['bytes=1024-', 'bytes=5000-6000', 'bytes=-0'])
+def test_unsatisfiable_range(server, range_header):
+    status, headers, body = _get(server, {'Range': range_header})
+    assert status == 416
+    assert headers['Content-Range'] == f"bytes */{len(DATA)}"
+    assert body == b''
+
+
+@pytest.mark.parametrize('range_header', ['bytes=20-10', 'bytes=0-1,5-9', 'items=0-10', 'bytes=-'])
+def test_ignored_range(server, range_header):
+    # Intervalli invertiti, multipli o malformati: si risponde con tutto il file
+    status, headers, body = _get(server, {'Range': range_header})
+    assert status == 200
+    assert body == DATA
+    assert 'Content-Range' not in headers
+
+
+def test_if_range_match(server):
+    status, _, body = _get(server, {'Range': 'bytes=0-9', 'If-Range': _etag(server)})
+    assert status == 206
+    assert body == DATA[:10]
+
+
+def test_if_range_mismatch(server):
+    status, _, body = _get(server, {'Range': 'bytes=0-9', 'If-Range': '"altro"'})
+    assert status == 200
+    assert body == DATA
+
+
+def test_if_none_match(server):
+    etag = _etag(server)
+    status, headers, body = _get(server, {'If-None-Match': f'"altro", {etag}'})
+    assert status == 304
+    assert headers['ETag'] == etag
+    assert body == b''
+
+
+def test_head_has_no_body(server):
+    status, headers, body = _get(server, method='HEAD')
+    assert status == 200
+    assert headers['Content-Length'] == str(len(DATA))
+    assert body == b''
@@ -0,0 +1,108 @@
+import io
+import struct
+import numpy as np
+import pytest
+from PIL import Image
+
+from gif_encoder import IncrementalGifWriter
+
+SIZE = (40, 30)
+COLORS = [(255, 0, 0), (0, 128, 255), (20, 200, 40)]
+
+
+def _frame(color):
+    """Frame a tinta unita con un quadrato nero, per controllare anche la geometria"""
+    frame = np.zeros((SIZE[1], SIZE[0], 3), dtype=np.uint8)
+    frame[:] = color
+    frame[5:15, 10:20] = 0
+    return frame
+
+
+def _pil_gif(frame):
+    """GIF a frame singolo scritta da Pillow (palette globale)"""
+    buf = io.BytesIO()
+    Image.fromarray(frame).convert('P', palette=Image.Palette.ADAPTIVE, colors=256).save(buf, format='GIF')
+    return buf.getvalue()
+
+
+def _to_local_palette(data):
+    """Sposta la palette globale nel descrittore dell'immagine (palette locale)"""
+    width, height, packed, background, aspect = struct.unpack_from('<HHBBB', data, 6)
+    assert packed & 0x80
+    bits = packed & 0x07
+    table_len = 3 * (2 ** (bits + 1))
+    table = data[13:13 + table_len]
+    rest = data[13 + table_len:]
+    header = data[:6] + struct.pack('<HHBBB', width, height, packed & 0x70, background, aspect)
+
+    pos = 0
+    while rest[pos] == 0x21:
+        pos += 2
+        while rest[pos]:
+            pos += rest[pos] + 1
+        pos += 1
+    assert rest[pos] == 0x2c
+    left, top, w, h, img_packed = struct.unpack_from('<HHHHB', rest, pos + 1)
+    assert not img_packed & 0x80
+    descriptor = b'\x2c' + struct.pack('<HHHHB', left, top, w, h, img_packed | 0x80 | bits)
+    return header + rest[:pos] + descriptor + table + rest[pos + 10:]
+
+
+def _read_frames(path):
+    with Image.open(path) as im:
+        frames = []
+        for i in range(im.n_frames):
+            im.seek(i)
+            frames.append((np.asarray(im.convert('RGB')), im.info.get('duration'), im.size))
+        return frames
+
+
+def _check(path, fps=1.5):
+    frames = _read_frames(path)
+    assert len(frames) == len(COLORS)
+    for (pixels, duration, size), color in zip(frames, COLORS):
+        assert size == SIZE
+        assert duration == int(round(100 / fps)) * 10
+        assert tuple(pixels[25, 35]) == color
+        assert tuple(pixels[10, 15]) == (0, 0, 0)
+
+
+def test_roundtrip_global_palette(tmp_path):
+    path = str(tmp_path / 'out.gif')
+    with IncrementalGifWriter(path, fps=1.5) as writer:
+        for color in COLORS:
+            writer.add_frame(_frame(color))
+    assert writer.n_frames == len(COLORS)
+    _check(path)
+
+
+def test_roundtrip_local_palette(tmp_path):
+    path = str(tmp_path / 'out.gif')
+    with IncrementalGifWriter(path, fps=2) as writer:
+        for color in COLORS:
+            block = writer._extract_image_block(_to_local_palette(_pil_gif(_frame(color))))
+            writer.add_encoded_frame(block, SIZE)
+    _check(path, fps=2)
+
+
+def test_encoded_frames_are_reusable(tmp_path):
+    # I blocchi salvati in cache (ForecastStore) si rimontano in un'altra GIF
+    first = str(tmp_path / 'first.gif')
+    with IncrementalGifWriter(first) as writer:
+        blocks = [writer.add_frame(_frame(color)) for color in COLORS]
+    second = str(tmp_path / 'second.gif')
+    with IncrementalGifWriter(second) as writer:
+        for block in blocks:
+            writer.add_encoded_frame(block, SIZE)
+    with open(first, 'rb') as a, open(second, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_size_mismatch_aborts(tmp_path):
+    path = str(tmp_path / 'out.gif')
+    with pytest.raises(ValueError):
+        with IncrementalGifWriter(path) as writer:
+            writer.add_frame(_frame(COLORS[0]))
+            writer.add_frame(np.zeros((10, 10, 3), dtype=np.uint8))
+    assert not (tmp_path / 'out.gif').exists()
+    assert not (tmp_path / 'out.gif.tmp').exists()